@@ -1,2 +1,8 @@
 import apteligent.restapi
 from requests.exceptions import RequestException
+
+try:
+    from apteligent.asyncapi import AsyncClient
+except (ImportError, SyntaxError):
+    # AsyncClient needs python 3 and aiohttp.
+    AsyncClient = None
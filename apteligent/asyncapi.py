@@ -0,0 +1,384 @@
+'''
+Client of the Apteligent REST API built on asyncio and aiohttp. Requires
+python 3.5.3 or later and the aiohttp package.
+'''
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from libecgnoc import jsonstore
+from libecgnoc import textstore
+from apteligent.restapi import limiter
+
+log = logging.getLogger(__name__)
+
+
+def check_response(response, body):
+    """
+    Asyncio counterpart of restapi.check_http_interaction.
+    """
+    log.debug("<RESPONSE <-------------\nURL: %s\nHEADERS:\n%s\nBODY:\n%s\n",
+              response.url, response.headers, body)
+    status = response.status
+    if status < 300:
+        limit = response.headers.get('Rate-Limit-Limit', False)
+        if limit:
+            log.info('Rate limit: %s; Remaining requests: %s;'
+                     'Reset in %s seconds', limit,
+                     response.headers.get('Rate-Limit-Remaining', ''),
+                     response.headers.get('Rate-Limit-Reset', ''))
+    elif status < 400:
+        log.critical('Received redirect. HTTP status code: %s', status)
+    elif status == 400:
+        log.critical('Request parameters were invalid/malformed')
+    elif status == 403:
+        log.critical('OAuth authentication failed')
+    elif status == 429:
+        log.critical('API rate limit exceeded: %s', body)
+    elif status > 499:
+        log.error('Server error. HTTP status code: %s', status)
+    response.raise_for_status()
+
+
+class AsyncClient(object):
+    """
+    Implements a client of the Apteligent REST API with coroutines, so a
+    single thread can have many requests in flight. The endpoints are the
+    same as those of restapi.Client. The number of concurrent requests is
+    bounded by concurrency.
+
+    Use it as an async context manager or call close when done:
+
+        async with AsyncClient(project, **apteligentconf) as at:
+            pies = await asyncio.gather(*[
+                at.errorMonitoringPie(appid=appid, groupby='carrier')
+                for appid in appids])
+    """
+
+    def __init__(self, project, hostname, username, password,
+                 clientID, proxies=None, pool_connections=4, pool_maxsize=16,
+                 pool_block=True, timeout=60, rate_limit_retries=3,
+                 batch_size=25, cache_ttl=0, cache_size=256,
+                 cache_persist=False, cache_name='responses',
+                 persist_interval=300, reload_interval=60, refresh_margin=300,
+                 concurrency=64):
+        """
+        Takes the same arguments as restapi.Client. pool_maxsize limits the
+        number of connections to the Apteligent host. The other pool
+        arguments, batch_size and the cache arguments are accepted to share
+        apteligent.json with restapi.Client.
+        Requests are paced by the rate limiter shared with restapi.Client.
+        The token and the list of apps are kept in memory and their json files
+        are checked at most every reload_interval seconds. The token is
+        renewed in the background refresh_margin seconds before it expires. A
+        request refused with 403 is retried once with a new token.
+        Additional keyword arguments:
+        concurrency: max number of requests in flight
+        """
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.clientID = clientID
+        self.proxy = proxies.get('https') if proxies else None
+        self.pool_maxsize = pool_maxsize
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.rate_limit_retries = rate_limit_retries
+        self.reload_interval = reload_interval
+        self.refresh_margin = refresh_margin
+
+        cache = jsonstore.cache(project)
+        blacklist = textstore.blacklist(project)
+        self.token = cache('token')
+        self.apps = cache('apps')
+        self.app_blacklist = blacklist('app')
+        # Time of the last check of the json file of a store, by store name.
+        self._checked = dict()
+        # Task renewing the token before it expires.
+        self._refreshing = None
+
+        # Created on first use, aiohttp needs a running event loop.
+        self._session = None
+        self._semaphore = None
+        self._token_lock = None
+        self._apps_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _setup(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.pool_maxsize)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._token_lock = asyncio.Lock()
+            self._apps_lock = asyncio.Lock()
+
+    async def _request(self, method, path, authorize=True, **kwargs):
+        """
+        Perform a request on the Apteligent API and return the decoded json.
+        An authorized request that fails with 403 is retried once with a new
+        token.
+        """
+        self._setup()
+        url = 'https://' + self.hostname + path
+        if authorize:
+            headers = kwargs.setdefault('headers', dict())
+            headers['Authorization'] = await self.get_token()
+        response, body = await self._send(method, url, **kwargs)
+        if response.status == 403 and authorize:
+            log.warning('Authorization failed. Retrying %s with a new token.',
+                        url)
+            await self._renew_token(headers['Authorization'])
+            headers['Authorization'] = await self.get_token()
+            response, body = await self._send(method, url, **kwargs)
+        check_response(response, body)
+        return json.loads(body)
+
+    async def _send(self, method, url, **kwargs):
+        for attempt in range(self.rate_limit_retries + 1):
+            await asyncio.sleep(limiter.reserve())
+            async with self._semaphore:
+                async with self._session.request(
+                        method, url, proxy=self.proxy, **kwargs) as response:
+                    body = await response.text()
+            limiter.update(response.headers)
+            if response.status != 429 or attempt == self.rate_limit_retries:
+                break
+            reset = limiter.throttled(response.headers, body)
+            log.warning('Rate limit exceeded. Retrying %s in %s seconds.',
+                        url, reset)
+        return response, body
+
+    async def _load(self, store, fetch, force=False):
+        """
+        Return the in-memory store. See restapi.Client._load.
+        """
+        now = time.time()
+        checked = self._checked.get(store.name, 0)
+        if store.data and now < checked + self.reload_interval and not force:
+            return store
+        if store.exists():
+            try:
+                store.refresh()
+            except (ValueError, IOError, OSError):
+                await fetch()
+        else:
+            await fetch()
+        self._checked[store.name] = now
+        return store
+
+    def _bearer(self):
+        """
+        Return the authorization header of the token, None if there is none.
+        """
+        if 'access_token' not in self.token:
+            return None
+        return 'Bearer' + ' ' + self.token['access_token']
+
+    async def get_token(self):
+        """
+        Returns an existing OAuth token from cache for the Apteligent API or
+        fetches a new one using current credentials. A token that is about to
+        expire is renewed in the background, an expired one right away.
+        """
+        self._setup()
+        await self._load(self.token, lambda: self._renew_token(None))
+        authorization = self._bearer()
+        expiration = self.token.get('expiration', float('inf'))
+        now = time.time()
+        if now >= expiration:
+            await self._renew_token(authorization)
+            authorization = self._bearer()
+        elif now >= expiration - self.refresh_margin:
+            self._renew_token_background(authorization)
+        return authorization
+
+    async def _renew_token(self, authorization):
+        """
+        Replace the token used for authorization with a new one. Concurrent
+        callers wait for the one request in flight and then use its token.
+        """
+        self._setup()
+        async with self._token_lock:
+            if self._bearer() != authorization:
+                # Renewed while we waited.
+                return
+            # Another script may have renewed it already.
+            await self._load(self.token, self.new_token, force=True)
+            expiration = self.token.get('expiration', float('inf'))
+            if self._bearer() != authorization and (
+                    time.time() < expiration - self.refresh_margin):
+                return
+            await self.new_token()
+
+    def _renew_token_background(self, authorization):
+        if self._refreshing is not None and not self._refreshing.done():
+            return
+
+        async def renew():
+            try:
+                await self._renew_token(authorization)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError,
+                    KeyError):
+                log.exception('Failed to renew the authorization token.')
+
+        log.info('Authorization token expires within %s seconds, renewing.',
+                 self.refresh_margin)
+        self._refreshing = asyncio.ensure_future(renew())
+
+    async def new_token(self):
+        """
+        Fetch and store a new OAuth token from Apteligent.
+        """
+        log.info('Getting a new authorization token from apteligent')
+        payload = {'grant_type': 'password', 'username': self.username,
+                   'password': self.password}
+        token = await self._request(
+            'POST', '/v1.0/token', authorize=False, data=payload,
+            auth=aiohttp.BasicAuth(self.clientID, ''))
+        token['expiration'] = time.time() + token['expires_in']
+        self.token.update(token)
+        self.token.store()
+
+    async def appname(self, appId):
+        """
+        Return the appName based on appId.
+        """
+        apps = await self.get_apps()
+        return apps[appId]['appName']
+
+    async def get_apps(self):
+        return await self._load(self.apps, self.new_apps)
+
+    async def new_apps(self):
+        self._setup()
+        requested = time.time()
+        async with self._apps_lock:
+            if self.apps.last_update and self.apps.last_update > requested:
+                # Another task fetched the apps while we waited.
+                return
+            attr = ','.join(['appName', 'linkToAppStore', 'appVersions',
+                             'latestVersionString', 'iconURL'])
+            log.info('Retreiving the current list of apps from apteligent,'
+                     'with tracked attributes %s', attr)
+            apps = await self._request(
+                'GET', '/v1.0/apps',
+                headers={'Content-Type': 'application/json'},
+                params={'attributes': attr})
+
+            self.app_filter(apps)
+            self.apps.clear()
+            self.apps.update(apps)
+
+            log.info("List of apps has been updated.")
+            log.info("Tracking %s apps.", len(apps))
+            self.apps.store()
+
+    def app_filter(self, apps):
+        self.app_blacklist.refresh()
+        for appid in list(apps.keys()):
+            if appid in self.app_blacklist:
+                del apps[appid]
+            else:
+                del apps[appid]['links']
+
+    async def _post(self, path, parameters):
+        return await self._request(
+            'POST', path, data=json.dumps(parameters),
+            headers={'Content-Type': 'application/json'})
+
+    async def performanceManagementPie(self, appids=None, duration=15,
+                                       metric='volume', filterkey=None,
+                                       filtervalue=None, groupby=None):
+        """
+        PerformanceManagementPie API Call. See restapi.Client.
+        """
+        if appids is None:
+            appids = list((await self.get_apps()).keys())
+
+        parameters = dict()
+        parameters['params'] = {'appIds': appids, 'graph': metric,
+                                'duration': duration}
+        if groupby:
+            parameters['params']['groupBy'] = groupby
+        if filterkey:
+            parameters['params']['filters'] = {filterkey: filtervalue}
+
+        return await self._post('/v1.0/performanceManagement/pie',
+                                parameters)
+
+    async def errorMonitoringGraph(self, **kwargs):
+        kwargs.setdefault('metric', 'crashes')
+        return await self.errorMonitoring('/v1.0/errorMonitoring/graph',
+                                          **kwargs)
+
+    async def errorMonitoringPie(self, **kwargs):
+        kwargs.setdefault('metric', 'appLoads')
+        kwargs.setdefault('groupby', 'appId')
+        return await self.errorMonitoring('/v1.0/errorMonitoring/pie',
+                                          **kwargs)
+
+    async def errorMonitoringSparklines(self, **kwargs):
+        kwargs.setdefault('metric', 'appLoads')
+        kwargs.setdefault('groupby', 'appId')
+        return await self.errorMonitoring('/v1.0/errorMonitoring/sparklines',
+                                          **kwargs)
+
+    async def errorMonitoring(self, path, appid=None, appids=None,
+                              metric='appLoads', duration=1440,
+                              filterkey=None, filtervalue=None, groupby=None):
+        """
+        ErrorMonitoring API Call. See restapi.Client.errorMonitoring.
+        """
+        parameters = dict()
+        parameters['params'] = {'graph': metric, 'duration': duration}
+        if appid is None and appids is None:
+            apps = await self.get_apps()
+            parameters['params']['appIds'] = list(apps.keys())
+        elif appids is None:
+            parameters['params']['appId'] = appid
+        else:
+            parameters['params']['appIds'] = appids
+
+        if groupby:
+            parameters['params']['groupBy'] = groupby
+        if filterkey:
+            parameters['params']['filters'] = {filterkey: filtervalue}
+
+        return await self._post(path, parameters)
+
+    async def livestats_totals(self, app_id, app_version='total'):
+        """
+        API Call to the beta of Apteligent livestats. See restapi.Client.
+        """
+        return await self._request(
+            'POST', '/v1.0/liveStats/totals/{}'.format(app_id),
+            params={'app_version': app_version})
+
+    async def livestats_periodic(self, app_id, app_version='total',
+                                 init=True):
+        """
+        API Call to the beta of Apteligent livestats. See restapi.Client.
+        """
+        parameters = dict()
+        parameters['app_version'] = app_version
+        if init:
+            parameters['initialize'] = 1
+        return await self._request(
+            'POST', '/v1.0/liveStats/periodic/{}'.format(app_id),
+            params=parameters)
@@ -1,11 +1,15 @@
 from __future__ import unicode_literals
-from builtins import object
+from builtins import object, range
+import atexit
 import json
 import time
+import threading
 import requests
+from requests.structures import CaseInsensitiveDict
 import logging
 from libecgnoc import jsonstore
 from libecgnoc import textstore
+from libecgnoc.lrucache import LRUCache
 
 log = logging.getLogger(__name__)
 
@@ -36,7 +40,10 @@ def check_http_interaction(response):
     elif response.status_code == 403:
         log.critical('OAuth authentication failed')
     elif response.status_code == 429:
-        failure = response.json
+        try:
+            failure = response.json()
+        except ValueError:
+            failure = dict()
         message = failure.get('message', 'API rate limit exceeded')
         actual = failure.get('actual', 'unknown')
         limit = failure.get('limit', 'unknown')
@@ -49,30 +56,395 @@ def check_http_interaction(response):
     response.raise_for_status()
 
 
+class RateLimiter(object):
+    """
+    Token bucket shared by all clients of the Apteligent API in this process.
+    The bucket is filled from the Rate-Limit-Remaining and Rate-Limit-Reset
+    headers of every response. The remaining requests are spread evenly over
+    the time until the reset. When the limit is exhausted, callers wait
+    until the reset.
+    """
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.waits = 0
+        self.throttles = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def update(self, headers):
+        """
+        Fill the bucket from the Rate-Limit-* headers of a response.
+        """
+        try:
+            limit = int(headers['Rate-Limit-Limit'])
+            remaining = int(headers['Rate-Limit-Remaining'])
+            reset = float(headers['Rate-Limit-Reset'])
+        except (KeyError, ValueError):
+            return
+        with self._lock:
+            self.limit = limit
+            self.remaining = remaining
+            self.reset_at = time.time() + reset
+
+    def throttled(self, headers, body):
+        """
+        Empty the bucket after a 429 response with headers and body text.
+        Returns the number of seconds until the limit resets.
+        """
+        reset = headers.get('Rate-Limit-Reset')
+        if reset is None:
+            try:
+                reset = json.loads(body).get('reset')
+            except (ValueError, AttributeError):
+                pass
+        try:
+            reset = float(reset)
+        except (TypeError, ValueError):
+            reset = 60
+        with self._lock:
+            self.throttles += 1
+            self.remaining = 0
+            self.reset_at = time.time() + reset
+        return reset
+
+    def reserve(self):
+        """
+        Take a token from the bucket. Returns the number of seconds the caller
+        has to wait before sending its request.
+        """
+        with self._lock:
+            now = time.time()
+            if self.reset_at is None or now >= self.reset_at:
+                # Nothing known about the current window.
+                self.reset_at = None
+                return 0
+            if self.remaining <= 0:
+                self.waits += 1
+                return self.reset_at - now
+            slot = max(now, self._next)
+            self._next = slot + (self.reset_at - slot) / self.remaining
+            self.remaining -= 1
+            if slot > now:
+                self.waits += 1
+            return slot - now
+
+    def acquire(self):
+        """
+        Wait for a token from the bucket. Asyncio callers should sleep for
+        reserve() seconds instead.
+        """
+        delay = self.reserve()
+        if delay > 0:
+            log.debug('Rate limit: waiting %.2f seconds', delay)
+            time.sleep(delay)
+
+    def stats(self):
+        return {'limit': self.limit, 'remaining': self.remaining,
+                'waits': self.waits, 'throttles': self.throttles}
+
+
+limiter = RateLimiter()
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU cache of API responses. Entries are fresh for ttl seconds.
+    Stale entries are kept for revalidation with ETag or Last-Modified, so an
+    unchanged response costs a 304 instead of a full body. When a JSONstore
+    is given, the cache is loaded from it and stored to it at most every
+    persist_interval seconds and at exit, so it survives a restart of the
+    script.
+    """
+
+    def __init__(self, ttl, maxsize=256, store=None, persist_interval=300):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.persist_interval = persist_interval
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._store = store
+        self._cache = LRUCache(maxsize)
+        self._lock = threading.Lock()
+        self._persist_lock = threading.Lock()
+        self._dirty = False
+        self._persisted = time.time()
+        if store is not None:
+            for key, entry in sorted(store.items(),
+                                     key=lambda item: item[1]['stored']):
+                self._cache.put(key, entry)
+            atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self._cache)
+
+    @staticmethod
+    def key(method, url, params=None, data=None):
+        """
+        Return the cache key of a request. Headers are left out, they only
+        carry the OAuth token and content type.
+        """
+        return json.dumps([method, url, params, data], sort_keys=True)
+
+    def get(self, key):
+        """
+        Return (entry, fresh) for key, or (None, False) if it is not cached.
+        """
+        entry = self._cache.get(key)
+        fresh = entry is not None and time.time() < entry['stored'] + self.ttl
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry, fresh
+
+    def put(self, key, response):
+        entry = {'stored': time.time(),
+                 'url': response.url,
+                 'status': response.status_code,
+                 'headers': dict(response.headers),
+                 'body': response.text}
+        self._cache.put(key, entry)
+        with self._lock:
+            self._dirty = True
+        self._persist()
+
+    def touch(self, key, entry):
+        """
+        Mark a revalidated entry as fresh again.
+        """
+        entry['stored'] = time.time()
+        with self._lock:
+            self.revalidated += 1
+            self._dirty = True
+        self._persist()
+
+    def flush(self):
+        """
+        Store the cache now if it changed since it was last stored.
+        """
+        self._persist(force=True)
+
+    def _persist(self, force=False):
+        if self._store is None:
+            return
+        now = time.time()
+        with self._lock:
+            due = self._persisted + self.persist_interval
+            if not self._dirty or (not force and now < due):
+                return
+            self._dirty = False
+            self._persisted = now
+        # Write outside the cache lock, lookups do not wait for the disk.
+        with self._persist_lock:
+            self._store.clear()
+            self._store.update(self._cache.items())
+            try:
+                self._store.store()
+            except (IOError, OSError, ValueError):
+                log.warning('Unable to persist the response cache.')
+
+    def stats(self):
+        """
+        Return the number of hits, misses, revalidations, the hit rate and the
+        size.
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'revalidated': self.revalidated,
+                'hit_rate': float(self.hits) / total if total else 0.0,
+                'size': len(self._cache)}
+
+
+def cached_response(entry, request):
+    """
+    Rebuild a requests.Response from a cache entry.
+    """
+    response = requests.Response()
+    response.status_code = entry['status']
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response._content = entry['body'].encode('utf-8')
+    response.encoding = 'utf-8'
+    response.url = entry['url']
+    response.request = request
+    return response
+
+
 class Client(object):
     """
     Implements a client of the Apteligent REST API.
     """
 
     def __init__(self, project, hostname, username, password,
-                 clientID, proxies=None):
+                 clientID, proxies=None, pool_connections=4, pool_maxsize=16,
+                 pool_block=True, timeout=None, rate_limit_retries=3,
+                 batch_size=25, cache_ttl=0, cache_size=256,
+                 cache_persist=False, cache_name='responses',
+                 persist_interval=300, reload_interval=60, refresh_margin=300):
         """
         Initialize the REST API using provided Apteligent credentials.
         The following keyword arguments need to be provided:
         hostname, username, password and clientID
         Optionally a list of proxies could be given.
+        The HTTP connection pool can be sized with pool_connections (number of
+        hosts to keep pools for), pool_maxsize (number of keep-alive
+        connections per host) and pool_block (wait for a free connection
+        instead of opening a throwaway one when the pool is exhausted).
+        A timeout in seconds for every request is set with timeout.
+        Requests are paced by the shared rate limiter. A request that exceeds
+        the rate limit is retried rate_limit_retries times after the reset.
+        Batched requests for many apps ask for at most batch_size apps at once.
+        Responses of the errorMonitoring and performanceManagement endpoints
+        are cached for cache_ttl seconds when it is set. The cache holds
+        cache_size responses. When cache_persist is set it is stored as
+        cache_name in the project cache directory every persist_interval
+        seconds and at exit. Give every script its own cache_name.
+        The token and the list of apps are kept in memory. Their json files
+        are checked for changes by other scripts at most every reload_interval
+        seconds. The token is renewed in the background refresh_margin
+        seconds before it expires. A request refused with 403 is retried once
+        with a new token.
         """
         self.hostname = hostname
         self.username = username
         self.password = password
         self.clientID = clientID
         self.proxies = proxies
+        self.timeout = timeout
+        self.rate_limit_retries = rate_limit_retries
+        self.batch_size = batch_size
+        self.reload_interval = reload_interval
+        self.refresh_margin = refresh_margin
+
+        # A single session shares its keep-alive connections between all
+        # calls and threads, so only the first request to the Apteligent host
+        # pays for the TCP and TLS handshake.
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.adapter = adapter
 
         cache = jsonstore.cache(project)
         blacklist = textstore.blacklist(project)
         self.token = cache('token')
         self.apps = cache('apps')
         self.app_blacklist = blacklist('app')
+        # Time of the last check of the json file of a store, by store name.
+        self._checked = dict()
+        self._store_lock = threading.RLock()
+        # Only one token request in flight, see _renew_token.
+        self._token_lock = threading.Lock()
+        self._refreshing = False
+
+        self.cache = None
+        if cache_ttl:
+            store = cache(cache_name) if cache_persist else None
+            self.cache = ResponseCache(cache_ttl, cache_size, store,
+                                       persist_interval)
+
+    def cache_stats(self):
+        """
+        Return the hits and misses of the response cache, None if disabled.
+        """
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def pool_stats(self):
+        """
+        Return the number of requests served by the connection pool. A hit is
+        a request on a reused keep-alive connection, a miss is a request that
+        needed a new connection.
+        """
+        pools = self.adapter.poolmanager.pools
+        requests_total = 0
+        connections = 0
+        for key in list(pools.keys()):
+            try:
+                pool = pools[key]
+            except KeyError:
+                # Pool was evicted in the mean time.
+                continue
+            requests_total += pool.num_requests
+            connections += pool.num_connections
+        return {'requests': requests_total,
+                'hits': requests_total - connections,
+                'misses': connections}
+
+    def _cached_request(self, method, url, **kwargs):
+        """
+        Perform a request through the response cache, if enabled. A fresh
+        cached response is returned without a request. A stale one is
+        revalidated with the validators it was stored with.
+        """
+        if self.cache is None:
+            return self._request(method, url, **kwargs)
+
+        key = self.cache.key(method, url, kwargs.get('params'),
+                             kwargs.get('data'))
+        entry, fresh = self.cache.get(key)
+        if entry is not None:
+            request = requests.Request(method, url,
+                                       headers=kwargs.get('headers'),
+                                       data=kwargs.get('data')).prepare()
+            if fresh:
+                return cached_response(entry, request)
+            headers = dict(kwargs.get('headers') or ())
+            validators = CaseInsensitiveDict(entry['headers'])
+            if 'ETag' in validators:
+                headers['If-None-Match'] = validators['ETag']
+            if 'Last-Modified' in validators:
+                headers['If-Modified-Since'] = validators['Last-Modified']
+            kwargs['headers'] = headers
+
+        r = self._request(method, url, **kwargs)
+        if r.status_code == 304 and entry is not None:
+            self.cache.touch(key, entry)
+            return cached_response(entry, r.request)
+        if r.status_code == 200:
+            self.cache.put(key, r)
+        return r
+
+    def _request(self, method, url, **kwargs):
+        """
+        Perform a request on the pooled session, paced by the rate limiter.
+        Requests that hit the rate limit are retried once it resets.
+        An authorized request that fails with 403 is retried once with a new
+        token.
+        """
+        kwargs.setdefault('proxies', self.proxies)
+        kwargs.setdefault('timeout', self.timeout)
+        r = self._send(method, url, **kwargs)
+        authorization = (kwargs.get('headers') or {}).get('Authorization')
+        if r.status_code == 403 and authorization:
+            log.warning('Authorization failed. Retrying %s with a new token.',
+                        url)
+            self._renew_token(authorization)
+            kwargs['headers'] = dict(kwargs['headers'],
+                                     Authorization=self.get_token())
+            r = self._send(method, url, **kwargs)
+        return r
+
+    def _send(self, method, url, **kwargs):
+        for attempt in range(self.rate_limit_retries + 1):
+            limiter.acquire()
+            r = self.session.request(method, url, **kwargs)
+            limiter.update(r.headers)
+            if r.status_code != 429 or attempt == self.rate_limit_retries:
+                break
+            reset = limiter.throttled(r.headers, r.text)
+            log.warning('Rate limit exceeded. Retrying %s in %s seconds.',
+                        url, reset)
+        return r
 
     def all_your_base(self):
         """"
@@ -80,7 +452,7 @@ class Client(object):
         base path of this API version
         """
         url = 'https://' + self.hostname + '/allyourbase'
-        r = requests.get(url, proxies=self.proxies)
+        r = self._request('GET', url)
         log.debug("All your base belongs to:\n {}".format(r.text))
         r.raise_for_status()
         version = r.json()['versions']['v1']['latest']
@@ -94,25 +466,103 @@ class Client(object):
         """
         log.info('Retrieving list of API endpoints')
         url = 'https://' + self.hostname + basepath
-        r = requests.get(url, proxies=self.proxies)
+        r = self._request('GET', url)
         log.debug(r.text)
         r.raise_for_status()
         return r.json()['links']
 
+    def _load(self, store, fetch, force=False):
+        """
+        Return the in-memory store. Its json file is checked for changes at
+        most every reload_interval seconds, or now if force is set. fetch is
+        called to get new data from Apteligent when the file is missing or
+        unreadable.
+        """
+        with self._store_lock:
+            now = time.time()
+            checked = self._checked.get(store.name, 0)
+            recent = now < checked + self.reload_interval
+            if store.data and recent and not force:
+                return store
+            if store.exists():
+                try:
+                    store.refresh()
+                except (ValueError, IOError, OSError):
+                    pass
+                else:
+                    self._checked[store.name] = now
+                    return store
+        # fetch makes requests, which may wait for the rate limiter or renew
+        # the token, so it runs without holding the lock.
+        fetch()
+        with self._store_lock:
+            self._checked[store.name] = time.time()
+        return store
+
+    def _bearer(self):
+        """
+        Return the authorization header of the token, None if there is none.
+        """
+        with self._store_lock:
+            if 'access_token' not in self.token:
+                return None
+            return 'Bearer' + ' ' + self.token['access_token']
+
     def get_token(self):
         """
         Returns an existing OAuth token from cache for the Apteligent API or
-        fetches a new one using current credentials.
+        fetches a new one using current credentials. A token that is about to
+        expire is renewed in the background, an expired one right away.
         """
-        if self.token.exists():
-            try:
-                self.token.refresh()
-            except (ValueError, IOError, OSError):
-                self.new_token()
-        else:
+        self._load(self.token, lambda: self._renew_token(None))
+        authorization = self._bearer()
+        expiration = self.token.get('expiration', float('inf'))
+        now = time.time()
+        if now >= expiration:
+            self._renew_token(authorization)
+            authorization = self._bearer()
+        elif now >= expiration - self.refresh_margin:
+            self._renew_token_background(authorization)
+        return authorization
+
+    def _renew_token(self, authorization):
+        """
+        Replace the token used for authorization with a new one. Concurrent
+        callers wait for the one request in flight and then use its token.
+        _store_lock may be taken while holding _token_lock, never the other
+        way around.
+        """
+        with self._token_lock:
+            if self._bearer() != authorization:
+                # Renewed while we waited.
+                return
+            # Another script may have renewed it already.
+            self._load(self.token, self.new_token, force=True)
+            expiration = self.token.get('expiration', float('inf'))
+            if self._bearer() != authorization and (
+                    time.time() < expiration - self.refresh_margin):
+                return
             self.new_token()
 
-        return 'Bearer' + ' ' + self.token['access_token']
+    def _renew_token_background(self, authorization):
+        with self._store_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def renew():
+            try:
+                self._renew_token(authorization)
+            except (requests.RequestException, ValueError, KeyError):
+                log.exception('Failed to renew the authorization token.')
+            finally:
+                self._refreshing = False
+
+        log.info('Authorization token expires within %s seconds, renewing.',
+                 self.refresh_margin)
+        thread = threading.Thread(target=renew, name='token-refresh')
+        thread.daemon = True
+        thread.start()
 
     def new_token(self):
         """
@@ -124,14 +574,15 @@ class Client(object):
                    'password': self.password}
         path = '/v1.0/token'
         url = "https://" + self.hostname + path
-        r = requests.post(url, payload, auth=(self.clientID, ''),
-                          proxies=self.proxies)
+        r = self._request('POST', url, data=payload,
+                          auth=(self.clientID, ''))
 
         check_http_interaction(r)
-        self.token.update(r.json())
-        self.token['expiration'] = (
-            time.time() + self.token['expires_in'])
-        self.token.store()
+        token = r.json()
+        token['expiration'] = time.time() + token['expires_in']
+        with self._store_lock:
+            self.token.update(token)
+            self.token.store()
 
     def appname(self, appId):
         """
@@ -140,15 +591,7 @@ class Client(object):
         return self.get_apps()[appId]['appName']
 
     def get_apps(self):
-        if self.apps.exists():
-            try:
-                self.apps.refresh()
-            except (ValueError, IOError, OSError):
-                self.new_apps()
-        else:
-            self.new_apps()
-
-        return self.apps
+        return self._load(self.apps, self.new_apps)
 
     def new_apps(self):
         apps = self.__get_apps([
@@ -159,12 +602,13 @@ class Client(object):
             'iconURL'])
 
         self.app_filter(apps)
-        self.apps.clear()
-        self.apps.update(apps)
+        with self._store_lock:
+            self.apps.clear()
+            self.apps.update(apps)
+            self.apps.store()
 
         log.info("List of apps has been updated.")
         log.info("Tracking %s apps.", len(apps))
-        self.apps.store()
 
     def app_filter(self, apps):
         self.app_blacklist.refresh()
@@ -186,14 +630,13 @@ class Client(object):
         log.info('Retreiving the current list of apps from apteligent,'
                  'with tracked attributes %s', attr)
 
-        r = requests.get(
-            url,
+        r = self._request(
+            'GET', url,
             headers={
                 'Content-Type': 'application/json',
                 'Authorization': tokenstr
             },
-            params={'attributes': attr},
-            proxies=self.proxies)
+            params={'attributes': attr})
 
         check_http_interaction(r)
 
@@ -236,13 +679,12 @@ class Client(object):
         if filterkey:
             parameters['params']['filters'] = {filterkey: filtervalue}
 
-        payload = json.dumps(parameters)
+        payload = json.dumps(parameters, sort_keys=True)
 
-        r = requests.post(url,
-                          data=payload,
-                          headers={'Content-Type': 'application/json',
-                                   'Authorization': tokenstr},
-                          proxies=self.proxies)
+        r = self._cached_request('POST', url,
+                                 data=payload,
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': tokenstr})
 
         check_http_interaction(r)
 
@@ -291,6 +733,8 @@ class Client(object):
             parameters['params']['appIds'] = appids
         elif appids is None:
             parameters['params']['appId'] = appid
+        else:
+            parameters['params']['appIds'] = appids
 
         tokenstr = self.get_token()
 
@@ -299,18 +743,76 @@ class Client(object):
         if filterkey:
             parameters['params']['filters'] = {filterkey: filtervalue}
 
-        payload = json.dumps(parameters)
+        payload = json.dumps(parameters, sort_keys=True)
 
-        r = requests.post(url,
-                          data=payload,
-                          headers={'Content-Type': 'application/json',
-                                   'Authorization': tokenstr},
-                          proxies=self.proxies)
+        r = self._cached_request('POST', url,
+                                 data=payload,
+                                 headers={'Content-Type': 'application/json',
+                                          'Authorization': tokenstr})
 
         check_http_interaction(r)
 
         return r.json()
 
+    def errorMonitoringByApp(self, endpoint, appids, **kwargs):
+        """
+        Request an errorMonitoring metric for many apps in as few API calls
+        as possible. The apps are grouped by appId and requested in chunks of
+        batch_size apps. The response is split back per app.
+        Arguments:
+        - endpoint: graph, pie or sparklines
+        - appids: list of app IDs
+        The other keyword arguments are passed to errorMonitoring, except for
+        groupby which is always appId.
+        Returns a dict with for every appid the data in the form a request for
+        that single app would return it. Apps missing from the grouped
+        response, or whose chunk failed, are requested one by one. Apps for
+        which that fails too are left out.
+        """
+        path = '/v1.0/errorMonitoring/' + endpoint
+        kwargs.pop('groupby', None)
+        kwargs.setdefault('metric', 'appLoads')
+
+        results = dict()
+        calls = 0
+        for i in range(0, len(appids), self.batch_size):
+            chunk = appids[i:i + self.batch_size]
+            calls += 1
+            try:
+                response = self.errorMonitoring(path, appids=chunk,
+                                                groupby='appId', **kwargs)
+                data = response['data']
+            except (requests.RequestException, ValueError, LookupError):
+                log.exception('Failed to request %s for %s apps at once.',
+                              kwargs['metric'], len(chunk))
+                continue
+            # The graph endpoint returns a list of series, the pie and
+            # sparklines endpoints a list of slices. Both are grouped by appId.
+            for key in ('series', 'slices'):
+                for group in data.get(key, []):
+                    appid = group.get('appId', group.get('label',
+                                                         group.get('name')))
+                    if appid not in chunk:
+                        # Not split by app, requested one by one below.
+                        continue
+                    appdata = dict(data)
+                    appdata[key] = [group]
+                    results[appid] = {'data': appdata}
+
+        for appid in appids:
+            if appid in results:
+                continue
+            calls += 1
+            try:
+                results[appid] = self.errorMonitoring(path, appid=appid,
+                                                      **kwargs)
+            except (requests.RequestException, ValueError):
+                log.exception('Failed to request %s for app %s.',
+                              kwargs['metric'], appid)
+        log.info('Requested %s for %s apps in %s calls.', kwargs['metric'],
+                 len(appids), calls)
+        return results
+
     def livestats_totals(self, app_id, app_version='total'):
         """
         API Call to the beta of Apteligent livestats. Returns the current
@@ -325,10 +827,9 @@ class Client(object):
 
         url = "https://{}/v1.0/liveStats/totals/{}".format(self.hostname,
                                                            app_id)
-        r = requests.post(url,
+        r = self._request('POST', url,
                           headers={'Authorization': tokenstr},
-                          params={'app_version': app_version},
-                          proxies=self.proxies)
+                          params={'app_version': app_version})
 
         check_http_interaction(r)
 
@@ -355,10 +856,9 @@ class Client(object):
         parameters['app_version'] = app_version
         if init:
             parameters['initialize'] = 1
-        r = requests.post(url,
+        r = self._request('POST', url,
                           headers={'Authorization': tokenstr},
-                          params=parameters,
-                          proxies=self.proxies)
+                          params=parameters)
 
         check_http_interaction(r)
 
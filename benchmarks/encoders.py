@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+'''
+Micro-benchmark of the tographite message encoders. Compares plainmessage and
+picklemessage with encode_plain and encode_pickle.
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+import timeit
+from argparse import ArgumentParser
+
+from tographite.main import (plainmessage, picklemessage,
+                             encode_plain, encode_pickle)
+
+ENCODERS = [
+    ('plainmessage', plainmessage),
+    ('encode_plain', encode_plain),
+    ('picklemessage', picklemessage),
+    ('encode_pickle', encode_pickle),
+    ]
+
+
+def metrics(points):
+    """
+    Return points in the shape livestats submits them: a few series per app,
+    each series sharing its path.
+    """
+    series = 30 * 3
+    length = max(points // series, 1)
+    lst = list()
+    for i in range(series):
+        path = 'apteligent.App_{}.live.metric_{}'.format(i // 3, i % 3)
+        lst.extend((path, float(j), 1460000000.0 + 10 * j)
+                   for j in range(length))
+    return lst[:points]
+
+
+def main(sizes, repeat):
+    print('{:>10} {:>15} {:>12} {:>12}'.format('points', 'encoder',
+                                               'seconds', 'points/s'))
+    for size in sizes:
+        data = metrics(size)
+        for name, encoder in ENCODERS:
+            seconds = min(timeit.repeat(lambda: encoder(data),
+                                        repeat=repeat, number=1))
+            print('{:>10} {:>15} {:>12.4f} {:>12.0f}'.format(
+                size, name, seconds, size / seconds))
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--points", dest="sizes", type=int,
+                        nargs='+', default=[10000, 100000, 1000000],
+                        help="Number of points to encode")
+    parser.add_argument("-r", "--repeat", dest="repeat", type=int,
+                        default=3, help="Best of this many runs")
+    args = parser.parse_args()
+
+    main(args.sizes, args.repeat)
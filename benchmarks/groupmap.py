@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+'''
+Micro-benchmark of carrier label matching. Compares the linear scan over the
+regular expressions of a groupmap section with findgroup, which remembers the
+group of every label. With --rules a generated section of that many rules is
+added, matched against labels of which some match no rule at all.
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+import logging
+import random
+import timeit
+from argparse import ArgumentParser
+
+from libecgnoc.groupmap import Groups, Regexgroup, GroupmapParser
+
+# Carrier labels in the shape errorMonitoringPie returns them. Most labels are
+# carrier names, some are mobile network codes or have no match but Other.
+LABELS = [
+    'Telstra', 'YES OPTUS', 'vodafone AU', 'Virgin', 'amaysim', '3',
+    'Verizon Wireless', 'T-Mobile', 'AT&T', 'Sprint', 'MetroPCS', 'Cricket',
+    'Rogers', 'Bell', 'TELUS', 'Fido', 'Koodo', 'Vidéotron', 'Claro AR',
+    'Movistar', 'Personal', 'Orange F', 'SFR', 'Bouygues Telecom',
+    'Free', 'Vodafone.de', 'Telekom.de', 'o2 - de', 'E-Plus', 'KPN',
+    'T-Mobile NL', 'Tele2', 'TIM', 'Wind', 'Tre', 'Iliad', 'EE', 'O2 - UK',
+    'Three', '3 UK', 'giffgaff', 'Tesco', 'Carrier', 'Wi-Fi', 'wifi',
+    '20404', '310260', 'unknown', '', 'Android',
+    ]
+
+
+def labels(count):
+    """
+    Return count labels, the popular ones more frequent than the others.
+    """
+    rnd = random.Random(42)
+    weights = [1.0 / (rank + 1) for rank in range(len(LABELS))]
+    cumulative = list()
+    total = 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    lst = list()
+    for _ in range(count):
+        x = rnd.random() * total
+        lst.append(LABELS[next(i for i, c in enumerate(cumulative)
+                               if c >= x)])
+    return lst
+
+
+def generated(rules):
+    """
+    Return a section of rules carrier expressions, each in its own group.
+    """
+    groups = Groups('generated')
+    for i in range(rules):
+        groups.add(Regexgroup('(?i)^carrier {} (mobile|wireless)'.format(i),
+                              'Carrier{}'.format(i)))
+    return groups
+
+
+def main(mapfile, count, repeat, rules):
+    sections = GroupmapParser(mapfile).parse()
+    data = labels(count)
+    if rules:
+        sections['generated'] = generated(rules)
+    print('{:>9} {:>8} {:>12} {:>12}'.format(
+        'section', 'rules', 'scan', 'findgroup'))
+    for name in sorted(sections):
+        groups = sections[name]
+        if name == 'generated':
+            # Labels of the last rules and labels that match none, the worst
+            # case for the scan.
+            data = [l for i in range(count)
+                    for l in ('carrier {} mobile'.format(rules - 1 - i % 10),
+                              LABELS[i % len(LABELS)])][:count]
+        results = list()
+        for method in (groups.scan, groups.findgroup):
+            seconds = min(timeit.repeat(lambda: [method(l) for l in data],
+                                        repeat=repeat, number=1))
+            results.append(seconds)
+        print('{:>9} {:>8} {:>12.4f} {:>12.4f}'.format(
+            name, len(groups.lst), *results))
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("-m", "--map", dest="mapfile",
+                        default='conf/carrier.map',
+                        help="Groupmap file to match against")
+    parser.add_argument("-n", "--labels", dest="count", type=int,
+                        default=10000, help="Number of labels to match")
+    parser.add_argument("-r", "--repeat", dest="repeat", type=int,
+                        default=3, help="Best of this many runs")
+    parser.add_argument("--rules", dest="rules", type=int, default=0,
+                        help="Add a generated section of this many rules")
+    args = parser.parse_args()
+
+    # Unmatched labels are logged as critical, keep them out of the results.
+    logging.disable(logging.CRITICAL)
+    main(args.mapfile, args.count, args.repeat, args.rules)
@@ -1,13 +1,19 @@
 from __future__ import absolute_import
-from builtins import next
 from builtins import str
 from builtins import object
 import logging
 import re
 import os
+import threading
+import time
+from libecgnoc import jsonstore
+from libecgnoc.lrucache import LRUCache
 from libecgnoc.resolvepaths import Resolve
 log = logging.getLogger(__name__)
 
+# Default of memo lookups, None is a valid group there.
+_MISSING = object()
+
 
 class Regexgroup(object):
     def __init__(self, regexp, group):
@@ -23,9 +29,15 @@ class Regexgroup(object):
 
 
 class Groups(object):
-    def __init__(self, name):
+    def __init__(self, name, maxsize=4096):
         self.name = name
         self.lst = list()
+        # Bounded LRU of the group found per topic, None if none matched.
+        self.memo = LRUCache(maxsize)
+        # Number of lookups per topic that matched no group, since the last
+        # pop_unmatched.
+        self.unmatched = dict()
+        self._lock = threading.Lock()
 
     def __str__(self):
         builder = ""
@@ -36,18 +48,72 @@ class Groups(object):
 
     def add(self, group):
         self.lst.append(group)
+        self.clear()
 
-    def findgroup(self, topic):
+    def clear(self):
+        with self._lock:
+            self.memo.clear()
+            self.unmatched.clear()
+
+    def remember(self, topic, group):
+        self.memo.put(topic, group)
+
+    def remembered(self):
+        """
+        Return the groups found per topic, leaving out unmatched topics.
+        """
+        return dict((topic, group) for topic, group in self.memo.items()
+                    if group is not None)
+
+    def pop_unmatched(self):
+        """
+        Return the unmatched lookups per topic and start counting anew.
+        """
+        with self._lock:
+            unmatched, self.unmatched = self.unmatched, dict()
+        return unmatched
+
+    def scan(self, topic):
+        """
+        Return the first candidate matching topic by trying them one by one.
+        """
         for candidate in self.lst:
             if topic in candidate:
-                log.debug('%s: %s matches %s so belongs to %s',
-                          self.name, topic, candidate.regexp, candidate.group)
-                return candidate.group
-        # None of the candidate groups matched.
-        log.critical('No group found for %s in table: %s', topic, self.name)
+                return candidate
+
+    def findgroup(self, topic):
+        """
+        Return the group of topic, None if no group matches. Unmatched topics
+        are logged the first time and counted after that, see unmatched.
+        """
+        group = self.memo.get(topic, _MISSING)
+        if group is not _MISSING:
+            if group is None:
+                with self._lock:
+                    self.unmatched[topic] = self.unmatched.get(topic, 0) + 1
+            return group
+
+        candidate = self.scan(topic)
+        if candidate is None:
+            # None of the candidate groups matched.
+            log.critical('No group found for %s in table: %s', topic,
+                         self.name)
+            with self._lock:
+                self.unmatched[topic] = self.unmatched.get(topic, 0) + 1
+            self.remember(topic, None)
+            return None
+        log.debug('%s: %s matches %s so belongs to %s',
+                  self.name, topic, candidate.regexp, candidate.group)
+        self.remember(topic, candidate.group)
+        return candidate.group
 
 
 class GroupmapParser(object):
+    """
+    Parses a map file line by line. A section starts with a [name] line and
+    holds a regular expression and a group per line, up to the next blank
+    line. Lines starting with # are comments.
+    """
 
     def __init__(self, filename):
         self.filename = filename
@@ -57,7 +123,7 @@ class GroupmapParser(object):
     def parse(self):
         try:
             store = self.store_iterator()
-            return self.scannext(store)
+            return self.scan(store)
         except:
             log.exception('Parsing failed at %s:%s', self.filename,
                           self.lineno)
@@ -68,47 +134,43 @@ class GroupmapParser(object):
             for lineno, line in enumerate(f, 1):
                 yield lineno, line
 
-    def createmap(self, line, store):
+    def scan(self, store):
+        groups = None
+        for self.lineno, line in store:
+            if line.startswith('#'):
+                continue
+            elif line.strip() == "":
+                if groups is not None:
+                    self.closemap(groups)
+                    groups = None
+            elif line.startswith('['):
+                if groups is not None:
+                    self.closemap(groups)
+                groups = self.createmap(line)
+            elif groups is not None:
+                self.addregex(line, groups)
+            else:
+                log.error('Line %s in %s, not handled.\n%s', self.lineno,
+                          self.filename, line)
+        if groups is not None:
+            self.closemap(groups)
+        return self.groupmap
+
+    def createmap(self, line):
         """
         Create a map with a name based on the following syntax: [name]
         """
-        name = line.strip('[]\n')
-        groups = Groups(name)
+        name = line.strip().strip('[]')
         log.debug('Creating list of groups for %s', name)
-        self.addregex(store, groups)
-        self.closemap(store, groups)
-        return
+        return Groups(name)
 
-    def addregex(self, store, groups):
-        try:
-            self.lineno, line = next(store)
-        except StopIteration:
-            return
-        if line.strip() == "":
-            return
+    def addregex(self, line, groups):
         regexp, group = line.split()
         groups.add(Regexgroup(regexp, group))
-        log.debug('%s ->  %s', regexp, group)
-        self.addregex(store, groups)
 
-    def closemap(self, store, groups):
+    def closemap(self, groups):
         self.groupmap[groups.name] = groups
-        log.debug('Close groupings for %s.', groups.name)
-
-    def scannext(self, store):
-        try:
-            linenumber, line = next(store)
-        except StopIteration:
-            return self.groupmap
-        if line == "" or line.startswith('#'):
-            return self.scannext(store)
-        elif line.startswith('['):
-            self.createmap(line, store)
-            return self.scannext(store)
-        else:
-            log.error('Line %s in %s, not handled.\n%s', linenumber,
-                      self.filename, line)
-            return self.scannext(store)
+        log.debug('Close %s groupings for %s.', len(groups.lst), groups.name)
 
 
 class Groupmap(object):
@@ -120,15 +182,30 @@ class Groupmap(object):
 
     Extension = '.map'
 
-    def __init__(self, storagedir, name):
+    def __init__(self, storagedir, name, cachedir=None):
+        """
+        The groups found per label are stored in cachedir, if given, so they
+        are known right away after a restart. They are discarded when the
+        map file has changed since.
+        """
         self.name = name
         self.path = os.path.join(storagedir, name + self.Extension)
         self.data = None
         self.last_update = None
+        self.mtime = None
+        self.labels = None
         if self.exists():
             self.load()
         else:
             raise RuntimeError('File %s does not exist', self.path)
+        if cachedir is not None:
+            try:
+                self.labels = jsonstore.JSONstore(cachedir, name + '_labels',
+                                                  readonly=False)
+            except (ValueError, IOError, OSError):
+                log.warning('Not caching the groups of %s labels.', name)
+            else:
+                self.warm()
 
     def __getitem__(self, key):
         return self.data[key]
@@ -143,16 +220,83 @@ class Groupmap(object):
     def exists(self):
         return os.path.isfile(self.path)
 
+    def last_modified(self):
+        try:
+            return os.path.getmtime(self.path)
+        except (IOError, OSError):
+            return 0
+
+    def refresh(self):
+        """
+        Reload the map file if it changed since it was loaded. The current
+        groups are kept if the new file fails to parse.
+        """
+        if self.mtime == self.last_modified():
+            return
+        try:
+            self.load()
+        except Exception:
+            log.error('Keeping the groups of %s loaded before.', self.path)
+            return
+        log.info('Reloaded %s after it changed.', self.path)
+
     def load(self):
+        mtime = self.last_modified()
         parser = GroupmapParser(self.path)
         self.data = parser.parse()
+        self.mtime = mtime
+        self.last_update = time.time()
+
+    def warm(self):
+        """
+        Fill the sections with the groups of labels stored for this version
+        of the map file.
+        """
+        if self.labels.get('mtime') != self.mtime:
+            return
+        sections = self.labels.get('sections', {})
+        for name, memo in sections.items():
+            if name in self.data:
+                for label, group in memo.items():
+                    self.data[name].remember(label, group)
+        log.info('Loaded %s cached labels for %s.',
+                 sum(len(memo) for memo in sections.values()), self.name)
+
+    def store(self):
+        """
+        Store the groups found per label in the cache directory.
+        """
+        if self.labels is None:
+            return
+        self.labels.clear()
+        self.labels['mtime'] = self.mtime
+        self.labels['sections'] = dict((name, groups.remembered())
+                                       for name, groups in self.data.items())
+        try:
+            self.labels.store()
+        except (ValueError, IOError, OSError):
+            log.warning('Unable to store the groups of %s labels.', self.name)
+
+    def unmatched(self):
+        """
+        Return the number of lookups of labels that matched no group since
+        the previous call, by section and label.
+        """
+        unmatched = dict()
+        for name, groups in self.data.items():
+            counts = groups.pop_unmatched()
+            if counts:
+                unmatched[name] = counts
+        return unmatched
 
 
-def groupmap(project, name=None):
-    path = Resolve(project).config()
+def groupmap(project, name=None, cache=True):
+    resolve = Resolve(project)
+    path = resolve.config()
+    cachedir = resolve.cache() if cache else None
 
     def creator(_name):
-        return Groupmap(path, _name)
+        return Groupmap(path, _name, cachedir)
 
     if name:
         return creator(name)
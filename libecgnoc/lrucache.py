@@ -0,0 +1,61 @@
+from __future__ import absolute_import
+from builtins import object
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread safe, bounded cache that evicts the least recently used key when
+    it holds more than maxsize keys. Counts hits and misses of get.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._cache.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Reinsert to mark as most recently used.
+            self._cache[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = value
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def items(self):
+        """
+        Return a list of (key, value) tuples, least recently used first.
+        """
+        with self._lock:
+            return list(self._cache.items())
+
+    def stats(self):
+        """
+        Return the number of hits, misses, the hit rate and the size.
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / total if total else 0.0,
+                'size': len(self._cache)}
@@ -8,40 +8,48 @@ from libecgnoc import (logger,
                        textstore)
 
 from libecgnoc.schedule import Event, ClockBasedScheduler
+from libecgnoc.resolvepaths import Resolve
 
 import tographite
 import apteligent
 
 
-def dailystats(metric_root, appid, at, gp):
+def dailystats(metric_root, appids, at, gp):
     """
-    Retreive daily stats of an app based on appid. Only the data of a complete
-    day, in other words
+    Retreive daily stats of the apps based on their appids. The apps are
+    requested together, so every metric takes a single call per batch of apps.
+    Only the data of a complete day, in other words
     yesterday, will be stored
     """
     yesterday = datetime.today().toordinal() - 1
     timestamp = time.mktime(datetime.fromordinal(yesterday).timetuple())
     apps = at.get_apps()
+    unknown = [appid for appid in appids if appid not in apps]
+    if unknown:
+        log.error('Skipping app IDs missing from the list of apps: %s',
+                  ', '.join(unknown))
+        appids = [appid for appid in appids if appid in apps]
 
     # If we want to stop tracking a metric remove it below.
     metrics = ['crashPercent', 'mau', 'dau', 'rating', 'appLoads', 'crashes',
                'affectedUsers', 'affectedUserPercent']
 
     for metric in metrics:
-        appName = apps[appid]['appName']
-        path = [metric_root, appName, 'daily', metric]
         # the errorMonitoring/graph API call returns an incomplete value for
         # the running day.
         # Request the data for two days and only use yesterdays value to track
         # the completed days.
-        stat = at.errorMonitoringGraph(appid=appid, metric=metric,
-                                       duration=2880)
-        try:
-            value = stat['data']['series'][0]['points'][0]
-        except LookupError:
-            log.exception('No data for metric: %s app: %s', metric, appName)
-        else:
-            gp.submit(path, value, timestamp)
+        stats = at.errorMonitoringByApp('graph', appids, metric=metric,
+                                        duration=2880)
+        for appid in appids:
+            appName = apps[appid]['appName']
+            path = [metric_root, appName, 'daily', metric]
+            try:
+                value = stats[appid]['data']['series'][0]['points'][0]
+            except LookupError:
+                log.error('No data for metric: %s app: %s', metric, appName)
+            else:
+                gp.submit(path, value, timestamp)
 
     gp.flush()
 
@@ -57,8 +65,12 @@ def main(project):
 
     try:
         metric_root = apteligentconf.data.pop('metric_root')
-        at = apteligent.restapi.Client(project, **apteligentconf.data)
-        gp = tographite.CarbonSink(**graphiteconf.data)
+        at = apteligent.restapi.Client(project,
+                                       cache_name='responses-dailyjobs',
+                                       **apteligentconf.data)
+        gp = tographite.CarbonSink(spool_dir=Resolve(project).cache(),
+                                   spool_name='dailyjobs',
+                                   **graphiteconf.data)
     except (KeyError, TypeError):
         log.exception('The json configuration files contains an improper key.')
         raise
@@ -68,6 +80,8 @@ def main(project):
     # Because the configured timezone determines the time the Crittercism
     # counters are reset,
     # we need to schedule the retreival of the data  based on this.
+    # Apps sharing a timezone are retreived together in one job.
+    hours = dict()
     for appid, (appname, timezone, country) in app_timezones.data.items():
         # skip apps in the blacklist
         if appid in app_blacklist:
@@ -75,23 +89,25 @@ def main(project):
         log.debug('App %s with appid %s, countrycode: %s, has GMT offset: %s',
                   appname, appid, country, timezone)
         if timezone < 0:
-            event = Event(0-timezone, 5, dailystats,
-                          metric_root, appid, at, gp)
+            hour = 0-timezone
         elif timezone > 0:
-            event = Event(24-timezone, 5, dailystats,
-                          metric_root, appid, at, gp)
+            hour = 24-timezone
         elif timezone == 0:
-            event = Event(0, 5, dailystats,
-                          metric_root, appid, at, gp)
+            hour = 0
         else:
             log.error('App %s with appid: %s,'
                       'has no timezone configured as GMT offset.',
                       appname, appid)
             raise ValueError('Improper GMT offset')
 
-        scheduler.addevent(event)
+        hours.setdefault(hour, []).append(appid)
+
+    for hour, appids in sorted(hours.items()):
+        log.debug('Retreiving daily stats of %s apps at %s:05',
+                  len(appids), hour)
+        scheduler.addevent(Event(hour, 5, dailystats,
+                                 metric_root, appids, at, gp))
 
-    scheduler.addevent(Event(1, 0, at.new_token))
     scheduler.addevent(Event(6, 0, at.new_apps))
     log.info('Starting schedule with %d jobs', len(scheduler.events))
     scheduler.run()
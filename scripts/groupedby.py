@@ -4,8 +4,9 @@ Script to retreive grouped mobile app data from the Crittercism REST API and
 store it into graphite.
 '''
 from __future__ import unicode_literals
-from builtins import object
+from builtins import object, range
 import time
+import concurrent.futures
 from argparse import ArgumentParser
 
 from libecgnoc import (logger,
@@ -13,6 +14,7 @@ from libecgnoc import (logger,
                        schedule)
 
 from libecgnoc.groupmap import groupmap
+from libecgnoc.resolvepaths import Resolve
 
 import apteligent
 import tographite
@@ -33,108 +35,267 @@ CARRIER_TRACKED_METRICS = [
         'appLoads'
         ]
 
-
-class BatchJob(object):
+DEVICE_TRACKED_METRICS = CARRIER_TRACKED_METRICS
+
+OS_TRACKED_METRICS = CARRIER_TRACKED_METRICS
+
+# The groupBy dimensions with the name of their metric path component and
+# map file, and the metrics tracked for them.
+DIMENSIONS = {
+        'appVersion': ('appversion', APPVERSION_TRACKED_METRICS),
+        'carrier': ('carrier', CARRIER_TRACKED_METRICS),
+        'device': ('device', DEVICE_TRACKED_METRICS),
+        'os': ('os', OS_TRACKED_METRICS),
+        }
+
+
+COUNT = 'count'
+GAUGE = 'gauge'
+RATIO = 'ratio'
+
+# The kind of each metric determines how the values of labels that map to the
+# same group are combined. Counts are summed and gauges averaged. Ratios are
+# not requested but derived per group from the sums of their numerator and
+# denominator, see RATIOS. Metrics that are not listed are counts.
+KINDS = {
+        'appLoads': COUNT,
+        'crashes': COUNT,
+        'affectedUsers': COUNT,
+        'dau': COUNT,
+        'mau': COUNT,
+        'rating': GAUGE,
+        'crashPercent': RATIO,
+        'affectedUserPercent': RATIO,
+        }
+
+# Ratio metrics as (numerator, denominator, factor).
+RATIOS = {
+        'crashPercent': ('crashes', 'appLoads', 100),
+        'affectedUserPercent': ('affectedUsers', 'dau', 100),
+        }
+
+
+def requested(metrics):
+    """
+    Return the metrics to request to track metrics. Ratios are replaced by
+    their numerator and denominator, each metric is requested once.
+    """
+    lst = list()
+    for metric in metrics:
+        if KINDS.get(metric, COUNT) == RATIO:
+            numerator, denominator, _ = RATIOS[metric]
+            needed = [numerator, denominator]
+        else:
+            needed = [metric]
+        lst.extend(m for m in needed if m not in lst)
+    return lst
+
+
+def mean(values):
+    return float(sum(values)) / len(values)
 
 
+class BatchJob(object):
 
-    def __init__(self, metric_root, at, gp, countries, carriers):
+    def __init__(self, metric_root, at, gp, countries, maps, workers=8):
+        """
+        maps holds the Groupmap to apply per groupBy dimension. Labels of
+        dimensions without a map are stored as they are.
+        """
         self.metric_root = metric_root
         self.at = at
         self.gp = gp
         self.countries = countries
-        self.carriers = carriers
+        self.maps = maps
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
 
-    def carrier(self):
+    def fanout(self, metrics, appids, groupby):
         """
-        For all the tracked apps get the Crittercism metrics per carrier
+        Request errorMonitoringPie for every metric and app concurrently.
+        Returns a generator of (metric, appid, stats) tuples in order of
+        completion. Failed requests are logged and yield None as stats.
         """
-
-
-        apps = self.at.get_apps()
-        appids = list(apps.keys())
-        # If we want to stop tracking a certain metric remove it below.
-        for metric in CARRIER_TRACKED_METRICS:
+        future_to_request = dict()
+        for metric in metrics:
             for appid in appids:
-                appName = apps[appid]['appName']
-                try:
-                    country = self.countries[appid][2]
-                except LookupError:
-                    log.exception('No timezone or country configuration.'
-                                  'appName: %s appid: %s', appName, appid)
-                    continue
-
-                timestamp = time.time()
-                prefix = [self.metric_root, appName, 'groupedby', 'carrier']
-                stats = self.at.errorMonitoringPie(
-                    appid=appid, metric=metric, groupby='carrier')
-                try:
-                    slices = stats['data']['slices']
-                    aggregator = dict()
-                    for sl in slices:
-                        blurb = sl['label']
-                        group = self.carriers[country].findgroup(blurb)
-                        value = sl['value']
-                        aggregator[group] = aggregator.get(group, 0) + value
-
-                    for group, value in aggregator.items():
-                        path = prefix + [group, metric]
-                        self.gp.submit(path, value, timestamp)
-
-                except LookupError:
-                    log.error('No data for metric: %s app: %s',
-                              metric, appName, exc_info=True)
+                future = self.executor.submit(
+                    self.at.errorMonitoringPie,
+                    appid=appid, metric=metric, groupby=groupby)
+                future_to_request[future] = (metric, appid)
+
+        for future in concurrent.futures.as_completed(future_to_request):
+            metric, appid = future_to_request[future]
+            try:
+                stats = future.result()
+            except apteligent.RequestException:
+                log.exception('Request failed for metric: %s app ID: %s',
+                              metric, appid)
+                stats = None
+            yield metric, appid, stats
 
-        self.gp.flush()
+    def carrier(self):
+        """
+        For all the tracked apps get the Crittercism metrics per carrier
+        """
+        self.grouped('carrier')
 
     def appversion(self):
         """
         For all the tracked apps get the Crittercism metrics per version
         """
+        self.grouped('appVersion')
 
+    def section(self, dimension, appid):
+        """
+        Return the groups of the map of dimension that apply to an app, None
+        if the labels are stored as they are.
+        Carriers are mapped per country, the other dimensions use the
+        [default] section of their map.
+        """
+        groupmap = self.maps.get(dimension)
+        if groupmap is None:
+            return None
+        if dimension == 'carrier':
+            return groupmap[self.countries[appid][2]]
+        return groupmap['default']
+
+    def aggregate(self, metric, slices, groups):
+        """
+        Combine the values of the slices whose labels map to the same group.
+        Returns a dict of values by group.
+        """
+        values = dict()
+        for sl in slices:
+            label = sl['label']
+            group = label if groups is None else groups.findgroup(label)
+            if group is None:
+                # Counted in the report of unmatched labels.
+                continue
+            values.setdefault(group, []).append(sl['value'])
+        combine = mean if KINDS.get(metric, COUNT) == GAUGE else sum
+        return dict((group, combine(v)) for group, v in values.items())
+
+    def derive(self, metric, totals):
+        """
+        Return the values by group of a ratio metric, computed from the
+        totals by group of its numerator and denominator. Returns None if
+        either is missing.
+        """
+        numerator, denominator, factor = RATIOS[metric]
+        if numerator not in totals or denominator not in totals:
+            return None
+        values = dict()
+        for group, total in totals[denominator].items():
+            if total:
+                values[group] = (float(totals[numerator].get(group, 0)) /
+                                 total * factor)
+        return values
+
+    def process(self, prefix, metrics, results, groups):
+        """
+        Submit the tracked metrics of an app from the slices of the requested
+        metrics in results. Metrics whose request failed are left out.
+        """
+        timestamp = time.time()
+        totals = dict()
+        for metric, slices in results.items():
+            if slices is not None:
+                totals[metric] = self.aggregate(metric, slices, groups)
+        for metric in metrics:
+            if KINDS.get(metric, COUNT) == RATIO:
+                values = self.derive(metric, totals)
+            else:
+                values = totals.get(metric)
+            if values is None:
+                log.error('No data for metric: %s path: %s', metric, prefix)
+                continue
+            for group, value in values.items():
+                path = prefix + [group, metric]
+                self.gp.submit(path, value, timestamp)
+
+    def grouped(self, dimension):
+        """
+        For all the tracked apps get the Crittercism metrics grouped by
+        dimension, mapped to fewer groups if dimension has a map.
+        """
+        start = time.time()
+        name, metrics = DIMENSIONS[dimension]
+        groupmap = self.maps.get(dimension)
+        if groupmap is not None:
+            groupmap.refresh()
         apps = self.at.get_apps()
-        appids = list(apps.keys())
-
-        for metric in APPVERSION_TRACKED_METRICS:
-            for appid in appids:
-                appName = apps[appid]['appName']
-                timestamp = time.time()
-                prefix = [self.metric_root, appName, 'groupedby', 'appversion']
-                stats = self.at.errorMonitoringPie(
-                    appid=appid, metric=metric, groupby='appVersion')
-                try:
-                    slices = stats['data']['slices']
-                    for sl in slices:
-                        group = sl['label']
-                        value = sl['value']
-                        path = prefix + [group, metric]
-                        self.gp.submit(path, value, timestamp)
-
-                except LookupError:
-                    log.error('No data for metric: %s app: %s',
-                              metric, appName, exc_info=True)
+        appids = list()
+        for appid in apps.keys():
+            if dimension != 'carrier' or appid in self.countries:
+                appids.append(appid)
+            else:
+                log.error('No timezone or country configuration.'
+                          'appName: %s appid: %s',
+                          apps[appid]['appName'], appid)
+
+        # Every metric is requested once per app, ratios are derived once
+        # all requests of an app are in.
+        fetch = requested(metrics)
+        results = dict((appid, dict()) for appid in appids)
+        for metric, appid, stats in self.fanout(fetch, appids, dimension):
+            appName = apps[appid]['appName']
+            try:
+                results[appid][metric] = stats['data']['slices']
+            except (LookupError, TypeError):
+                results[appid][metric] = None
+            if len(results[appid]) < len(fetch):
+                continue
+
+            prefix = [self.metric_root, appName, 'groupedby', name]
+            try:
+                groups = self.section(dimension, appid)
+            except LookupError as e:
+                log.error('No section in %s.map for app: %s (%r)',
+                          name, appName, e)
+                continue
+            self.process(prefix, metrics, results.pop(appid), groups)
 
         self.gp.flush()
+        if groupmap is not None:
+            groupmap.store()
+            unmatched = groupmap.unmatched()
+            if unmatched:
+                log.warning('%s labels without a group this run, by '
+                            'section: %s', dimension, unmatched)
+        log.info('%s job for %s apps finished in %.1f seconds, '
+                 '%s requests.', dimension, len(appids), time.time() - start,
+                 len(appids) * len(fetch))
 
 
-def main(project):
+def main(project, workers):
 
     config = jsonstore.config(project)
 
     apteligentconf = config('apteligent')
     graphiteconf = config('graphite')
     countries = config('app_timezones')
-    carriers = groupmap(project, 'carrier')
+    maps = {'carrier': groupmap(project, 'carrier')}
+    for dimension in ('appVersion', 'device', 'os'):
+        name = DIMENSIONS[dimension][0]
+        try:
+            maps[dimension] = groupmap(project, name)
+        except RuntimeError:
+            log.info('No %s.map, not grouping %s labels.', name, dimension)
 
     try:
         metric_root = apteligentconf.data.pop('metric_root')
-        at = apteligent.restapi.Client(project, **apteligentconf)
-        gp = tographite.CarbonSink(**graphiteconf)
+        at = apteligent.restapi.Client(project,
+                                       cache_name='responses-groupedby',
+                                       **apteligentconf)
+        gp = tographite.CarbonSink(spool_dir=Resolve(project).cache(),
+                                   spool_name='groupedby',
+                                   **graphiteconf)
     except TypeError:
         log.exception('The json configuration files contains an improper key.')
         raise
 
-    batchjob = BatchJob(metric_root, at, gp, countries, carriers)
+    batchjob = BatchJob(metric_root, at, gp, countries, maps, workers)
 
     # Important: the ClockBasedScheduler spawns threads, so Events can
     # run in parallel
@@ -158,6 +319,15 @@ def main(project):
     sched.addevent(event('*', 42, batchjob.carrier))
     sched.addevent(event('*', 52, batchjob.carrier))
 
+    # Devices and operating systems have too many distinct labels to store,
+    # so they are only tracked when a map groups them. Every 10 minutes
+    # starting from 4 and 6 past the whole hour.
+    for dimension, offset in (('device', 4), ('os', 6)):
+        if dimension in maps:
+            for minute in range(offset, 60, 10):
+                sched.addevent(event('*', minute, batchjob.grouped,
+                                     dimension))
+
     sched.run()
 
 
@@ -170,8 +340,11 @@ if __name__ == "__main__":
     parser.add_argument("-q", "--quiet", action="store_false",
                         dest="verbose", default=True,
                         help="Suppress debug level log messages")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        default=8,
+                        help="Number of concurrent requests to apteligent")
     args = parser.parse_args()
 
     log = logger.setup(args.project, __file__, debug=args.verbose)
 
-    main(args.project)
+    main(args.project, args.workers)
@@ -7,73 +7,197 @@ from __future__ import unicode_literals
 from __future__ import print_function
 from argparse import ArgumentParser
 from libecgnoc import logger, schedule, jsonstore
+from libecgnoc.resolvepaths import Resolve
+import heapq
+import threading
+import time
 import tographite
 import apteligent
 import concurrent.futures
 
+# Width of a livestats bucket in seconds.
+BUCKET = 10
+# Seconds after the close of a bucket in which it should be in carbon.
+MAX_LATENCY = 15
+
 
 class BatchJob(object):
+    """
+    Polls the livestats of apps. The time of the last bucket stored per app
+    is kept in lastsuccess, a dict or a JSONstore to keep it across restarts.
+    When the last stored bucket started less than three buckets ago, at most
+    one bucket was completed since, so only the last bucket is requested.
+    After a longer gap the full 5 minutes of buckets are requested.
+    """
 
-    def __init__(self, metric_root, at, gp):
+    def __init__(self, metric_root, at, gp, lastsuccess=None):
         self.metric_root = metric_root
         self.at = at
         self.gp = gp
-        self.lastsuccess = dict()
+        self.lastsuccess = dict() if lastsuccess is None else lastsuccess
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+        self._lock = threading.Lock()
+
+    def incremental(self, appid):
+        """
+        True if the last bucket is enough to continue where we left off.
+        """
+        lastsuccess = self.lastsuccess.get(appid, 0)
+        return time.time() - lastsuccess < 3 * BUCKET
+
+    def fetch(self, appid):
+        return self.at.livestats_periodic(appid,
+                                          init=not self.incremental(appid))
 
     def run(self, appids):
         failures = list()
 
         future_to_appid = dict()
         for appid in appids:
-            future = self.executor.submit(self.at.livestats_periodic, appid)
+            future = self.executor.submit(self.fetch, appid)
             future_to_appid[future] = appid
 
         for future in concurrent.futures.as_completed(future_to_appid):
             appid = future_to_appid[future]
-            appname = self.at.appname(appid)
-            prefix = [self.metric_root, appname, 'live']
-            apploads = tographite.main.sanitize(prefix + ['appLoads'])
-            crashes = tographite.main.sanitize(prefix + ['crashes'])
-            exceptions = tographite.main.sanitize(prefix + ['exceptions'])
-
             try:
                 result = future.result()
             except apteligent.RequestException:
-                failures.append(appid, prefix)
+                failures.append(appid)
                 log.exception('Request failed for %s with app ID: %s.',
-                              appname, appid)
+                              self.at.appname(appid), appid)
                 continue
+            self.process(appid, result)
 
-            if result['success'] == 1:
-                stats = result['periodic_data']
-            else:
-                log.error('Retrieval of livestats unsuccessful.'
-                          'appid: %s, appname: %s', appid, appname)
-                continue
+        self.store()
+        return failures
 
-            log.info('Received live stats (periodic)'
-                     'for %s with app ID: %s', appname, appid)
-            lastsuccess = self.lastsuccess.get(appid, 0)
+    def process(self, appid, result):
+        """
+        Submit the buckets of a livestats result that were not stored yet.
+        Returns the start time of the newest bucket, None if there was none.
+        """
+        appname = self.at.appname(appid)
+        prefix = [self.metric_root, appname, 'live']
+        apploads, crashes, exceptions = tographite.main.sanitize_many(
+            [prefix + ['appLoads'],
+             prefix + ['crashes'],
+             prefix + ['exceptions']])
 
-            for stat in stats:
-                # The Crittercism API returns milliseconds since epoch
-                # instead of seconds.
-                # To add insult to injury, the smallest interval returned
-                # by the api is 10 seconds
-                timestamp = stat['time']//1000
-                if timestamp > lastsuccess:
-                    self.gp.submit(apploads, stat['app_loads'], timestamp)
-                    self.gp.submit(crashes, stat['app_errors'], timestamp)
-                    self.gp.submit(exceptions, stat['app_exceptions'],
-                                   timestamp)
+        if result['success'] == 1:
+            stats = result['periodic_data']
+        else:
+            log.error('Retrieval of livestats unsuccessful.'
+                      'appid: %s, appname: %s', appid, appname)
+            return None
 
-            self.lastsuccess[appid] = stats[-1]['time']//1000
+        log.info('Received live stats (periodic)'
+                 'for %s with app ID: %s', appname, appid)
+        lastsuccess = self.lastsuccess.get(appid, 0)
 
-        return failures
+        # The Crittercism API returns milliseconds since epoch
+        # instead of seconds.
+        # To add insult to injury, the smallest interval returned
+        # by the api is 10 seconds
+        stats = [stat for stat in stats
+                 if stat['time']//1000 > lastsuccess]
+        timestamps = [stat['time']//1000 for stat in stats]
+        self.gp.submit_many(apploads,
+                            [stat['app_loads'] for stat in stats],
+                            timestamps)
+        self.gp.submit_many(crashes,
+                            [stat['app_errors'] for stat in stats],
+                            timestamps)
+        self.gp.submit_many(exceptions,
+                            [stat['app_exceptions'] for stat in stats],
+                            timestamps)
+
+        if not timestamps:
+            return None
+        with self._lock:
+            self.lastsuccess[appid] = timestamps[-1]
+        return timestamps[-1]
 
+    def poll(self, appid):
+        """
+        Fetch the livestats of a single app and send them to carbon right
+        away. Polls run on the executor and nobody reads their result, so
+        every error is logged here.
+        """
+        try:
+            result = self.fetch(appid)
+            newest = self.process(appid, result)
+            self.gp.flush()
+        except apteligent.RequestException:
+            log.exception('Request failed for app ID: %s.', appid)
+            return
+        except Exception:
+            log.exception('Failed to poll live stats of app ID: %s.', appid)
+            return
+        if newest is not None:
+            # Time from the close of the bucket until it was sent.
+            latency = time.time() - newest - BUCKET
+            if latency > MAX_LATENCY:
+                log.warning('Live stats of app ID %s sent %.1f seconds after '
+                            'the bucket closed.', appid, latency)
 
-def main(project, interval):
+    def stream(self, apps_interval=60):
+        """
+        Poll every app on its own cadence of one bucket and send the buckets
+        to carbon as soon as they are received. The first polls of the apps
+        are spread over a bucket, so their requests do not go out at once.
+        The list of apps is refreshed every apps_interval seconds.
+        """
+        schedule = list()
+        running = dict()
+        next_refresh = 0
+        while True:
+            now = time.time()
+            if now >= next_refresh:
+                appids = set(self.at.get_apps().keys())
+                schedule = [(due, appid) for due, appid in schedule
+                            if appid in appids]
+                scheduled = set(appid for _, appid in schedule)
+                new = sorted(appids - scheduled)
+                for i, appid in enumerate(new):
+                    schedule.append((now + BUCKET * float(i) / len(new),
+                                     appid))
+                heapq.heapify(schedule)
+                if new:
+                    log.info('Streaming live stats of %s new apps.',
+                             len(new))
+                self.store()
+                next_refresh = now + apps_interval
+
+            if not schedule:
+                time.sleep(max(next_refresh - now, 0))
+                continue
+            due, appid = schedule[0]
+            if due > now:
+                time.sleep(min(due, next_refresh) - now)
+                continue
+
+            # Skip ticks that were missed, instead of catching up with a
+            # burst of requests.
+            ticks = int((now - due) // BUCKET) + 1
+            heapq.heapreplace(schedule, (due + ticks * BUCKET, appid))
+            future = running.get(appid)
+            if future is not None and not future.done():
+                log.warning('Previous poll of app ID %s still running.',
+                            appid)
+                continue
+            running[appid] = self.executor.submit(self.poll, appid)
+
+    def store(self):
+        if isinstance(self.lastsuccess, jsonstore.JSONstore):
+            with self._lock:
+                try:
+                    self.lastsuccess.store()
+                except (IOError, OSError, ValueError):
+                    log.warning('Unable to store the time of the last '
+                                'buckets.')
+
+
+def main(project, interval, stream):
 
     config = jsonstore.config(project)
     apteligentconf = config('apteligent')
@@ -81,15 +205,25 @@ def main(project, interval):
 
     try:
         metric_root = apteligentconf.data.pop('metric_root')
-        at = apteligent.restapi.Client(project, **apteligentconf.data)
-        gp = tographite.CarbonSink(**graphiteconf.data)
+        at = apteligent.restapi.Client(project,
+                                       cache_name='responses-livestats',
+                                       **apteligentconf.data)
+        gp = tographite.CarbonSink(spool_dir=Resolve(project).cache(),
+                                   spool_name='livestats',
+                                   **graphiteconf.data)
     except (KeyError, TypeError):
         log.exception('The json configuration files contains'
                       'an improper key.')
         raise
 
     sched = schedule.EveryXMinutes(interval)
-    batchjob = BatchJob(metric_root, at, gp)
+    lastsuccess = jsonstore.cache(project)('livestats')
+    batchjob = BatchJob(metric_root, at, gp, lastsuccess)
+
+    if stream:
+        log.info('Streaming live stats every %s seconds.', BUCKET)
+        batchjob.stream()
+        return
 
     while True:
         sched.sleep_until_next_run()
@@ -116,6 +250,10 @@ if __name__ == "__main__":
                         help="Suppress debug level log messages")
     parser.add_argument("-i", "--interval", dest="interval", default=2,
                         help="Polling interval in minutes from 1 upto 5.")
+    parser.add_argument("-s", "--stream", action="store_true",
+                        dest="stream", default=False,
+                        help="Poll every app every 10 seconds and send the "
+                             "results right away, ignores the interval.")
     args = parser.parse_args()
 
     interval = int(args.interval)
@@ -123,4 +261,4 @@ if __name__ == "__main__":
 
     log = logger.setup(args.project, __file__, debug=args.verbose)
 
-    main(args.project, interval)
+    main(args.project, interval, args.stream)
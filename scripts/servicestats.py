@@ -5,12 +5,15 @@ into graphite.
 '''
 
 from __future__ import unicode_literals
-from builtins import object
+from builtins import object, range
 import time
+import random
+import concurrent.futures
 from libecgnoc import (logger,
                        schedule,
                        jsonstore,
                        textstore)
+from libecgnoc.resolvepaths import Resolve
 
 import apteligent
 from apteligent import RequestException
@@ -22,15 +25,21 @@ from argparse import ArgumentParser
 
 class BatchJob(object):
 
-    def __init__(self, metric_root, at, gp):
+    def __init__(self, metric_root, at, gp, workers=8, retries=2, backoff=5):
         self.metric_root = metric_root
         self.at = at
         self.gp = gp
         self.whitelist = None
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
 
     def run(self):
         """
         Stats on web services including ecg api services.
+        All requests run concurrently. Returns the requests that failed after
+        all retries.
         """
         failures = list()
         self.whitelist.refresh()
@@ -39,24 +48,48 @@ class BatchJob(object):
         # performanceManagementPie
         metrics = ['dataIn', 'dataOut', 'latency', 'volume', 'errors']
 
+        future_to_request = dict()
         apps = self.at.get_apps()
         for appId in apps:
             appName = apps[appId]['appName']
             prefix = [self.metric_root, appName, 'services']
             for metric in metrics:
-                try:
-                    data = self.at.performanceManagementPie(
-                        appids=[appId],
-                        metric=metric,
-                        groupby='service')
-                except:
-                    log.exception('Failed to get %s for %s.', metric, appId)
-                    failures.append((prefix, appId, metric))
-                    continue
-                self.process(prefix, metric, data)
+                future = self.executor.submit(self.fetch, appId, metric)
+                future_to_request[future] = (prefix, appId, metric)
+
+        for future in concurrent.futures.as_completed(future_to_request):
+            prefix, appId, metric = future_to_request[future]
+            try:
+                data = future.result()
+            except Exception:
+                # One failed request must not end the run, whatever the
+                # cause.
+                log.exception('Failed to get %s for %s.', metric, appId)
+                failures.append((prefix, appId, metric))
+                continue
+            self.process(prefix, metric, data)
 
         return failures
 
+    def fetch(self, appId, metric):
+        """
+        Request the performanceManagementPie of a metric for an app. Failed
+        requests are retried with an exponential backoff with jitter.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return self.at.performanceManagementPie(
+                    appids=[appId],
+                    metric=metric,
+                    groupby='service')
+            except RequestException:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                log.warning('Failed to get %s for %s. Retry in %.1f seconds.',
+                            metric, appId, delay, exc_info=True)
+                time.sleep(delay)
+
     def process(self, prefix, metric, data):
         """
         Before the results from a performanceManagementPie API call can be send
@@ -71,25 +104,8 @@ class BatchJob(object):
                 self.gp.submit(
                     path, dataslice['value'], timestamp)
 
-    def retry(self, failures):
-        """
-        Failed requests are retried one time
-        """
-        log.info('Retrying %s failed apteligent requests.', len(failures))
-        for prefix, appId, metric in failures:
-            try:
-                data = self.at.performanceManagementPie(
-                    appids=[appId],
-                    metric=metric,
-                    groupby='service')
-            except RequestException:
-                log.exception('Abandoning current run.'
-                              'Flushing current buffer.'
-                              'Retry at next run.')
-            self.process(prefix, metric, data)
-
 
-def main(project):
+def main(project, workers):
 
     config = jsonstore.config(project)
 
@@ -98,23 +114,29 @@ def main(project):
 
     try:
         metric_root = apteligentconf.pop('metric_root')
-        at = apteligent.restapi.Client(project, **apteligentconf)
-        gp = tographite.CarbonSink(**graphiteconf)
+        at = apteligent.restapi.Client(project,
+                                       cache_name='responses-servicestats',
+                                       **apteligentconf)
+        gp = tographite.CarbonSink(spool_dir=Resolve(project).cache(),
+                                   spool_name='servicestats',
+                                   **graphiteconf)
     except TypeError:
         log.exception('The json configuration files contain an improper key.')
         raise
 
     sched = schedule.EveryXMinutes(15)
-    batchjob = BatchJob(metric_root, at, gp)
+    batchjob = BatchJob(metric_root, at, gp, workers)
     batchjob.whitelist = textstore.whitelist(project, 'services')
 
     while True:
         sched.sleep_until_next_run()
+        start = time.time()
         failures = batchjob.run()
         if failures:
-            time.sleep(120)
-            batchjob.retry(failures)
+            log.error('Giving up on %s failed requests until the next run.',
+                      len(failures))
         gp.flush()
+        log.info('Run finished in %.1f seconds.', time.time() - start)
 
 if __name__ == "__main__":
 
@@ -125,8 +147,11 @@ if __name__ == "__main__":
     parser.add_argument("-q", "--quiet", action="store_false",
                         dest="verbose", default=True,
                         help="Suppress debug level log messages")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        default=8,
+                        help="Number of concurrent requests to apteligent")
     args = parser.parse_args()
 
     log = logger.setup(args.project, __file__, debug=args.verbose)
 
-    main(args.project)
+    main(args.project, args.workers)
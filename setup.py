@@ -62,5 +62,9 @@ setup(
         'scripts/groupedby.py'
         ],
     license='MIT',
-    install_requires=requirements()
+    install_requires=requirements(),
+    extras_require={
+        # apteligent.AsyncClient
+        'async': ['aiohttp>=3.3.0; python_version>="3.5"']
+        }
     )
@@ -0,0 +1,55 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from builtins import object, range
+import bisect
+from hashlib import md5
+
+
+def compact_hash(string):
+    return md5(string.encode('utf-8')).hexdigest()
+
+
+def node_name(server, instance):
+    """
+    Return the name carbon hashes for a node: the string representation of
+    the (server, instance) tuple in python 2.
+    """
+    if instance is None:
+        return "('{}', None)".format(server)
+    return "('{}', '{}')".format(server, instance)
+
+
+class ConsistentHashRing(object):
+    """
+    Consistent hash ring compatible with carbon.hashing.ConsistentHashRing,
+    so metrics end up on the same carbon-cache as they would through a
+    carbon-relay with the consistent-hashing relay method.
+    Nodes are (server, instance) tuples.
+    """
+
+    def __init__(self, nodes=(), replica_count=100):
+        self.ring = list()
+        self.nodes = set()
+        self.replica_count = replica_count
+        for node in nodes:
+            self.add_node(node)
+
+    def compute_ring_position(self, key):
+        return int(compact_hash(key)[:4], 16)
+
+    def add_node(self, node):
+        self.nodes.add(node)
+        positions = set(position for position, _ in self.ring)
+        for i in range(self.replica_count):
+            replica_key = '{}:{}'.format(node_name(*node), i)
+            position = self.compute_ring_position(replica_key)
+            while position in positions:
+                position += 1
+            positions.add(position)
+            bisect.insort(self.ring, (position, node))
+
+    def get_node(self, key):
+        assert self.ring
+        position = self.compute_ring_position(key)
+        index = bisect.bisect_left(self.ring, (position,)) % len(self.ring)
+        return self.ring[index][1]
@@ -2,10 +2,20 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 from builtins import (object, zip)
 import logging
+import numbers
 import pickle
+import select
 import struct
 import socket
+import threading
+import time
 from collections import deque, namedtuple
+from contextlib import contextmanager
+from queue import Queue, Full, Empty
+from itertools import repeat
+from libecgnoc.lrucache import LRUCache
+from tographite.spool import Spool
+from tographite.hashing import ConsistentHashRing
 
 log = logging.getLogger(__name__)
 
@@ -28,14 +38,54 @@ transtable.update(deltable)
 
 Metric = namedtuple('Metric', ['path', 'value', 'timestamp'])
 
+# Policies of an asynchronous CarbonSink when its queue is full.
+WHEN_FULL = ('block', 'drop-oldest', 'drop-newest')
+
+# Put on the queue to stop the writer thread of an asynchronous CarbonSink.
+_STOP = object()
+
+
+class PathCache(LRUCache):
+    """
+    Bounded LRU cache of sanitized metric paths. Metric paths are rebuilt
+    from the same components every run, so they only need to be sanitized
+    once.
+    """
+
+    def __init__(self, maxsize=10000):
+        super(PathCache, self).__init__(maxsize)
+
+
+pathcache = PathCache()
+
 
 def sanitize(path):
     """
     Sanitize the input metric paths and accepts lists or dot seperated strings.
     Returns a dot separated string in unicode/ python 3 string.
     Bytes or python2 strings are decoded to unicode.
+    Results are cached in pathcache.
+    """
+    if type(path) == list:
+        key = tuple(path)
+    else:
+        key = path
+
+    sanitized = pathcache.get(key)
+    if sanitized is None:
+        sanitized = _sanitize(path)
+        pathcache.put(key, sanitized)
+    return sanitized
+
+
+def sanitize_many(paths):
     """
+    Sanitize a list of metric paths. Returns a list of dot separated strings.
+    """
+    return [sanitize(path) for path in paths]
+
 
+def _sanitize(path):
     if type(path) == list:
             l = list()
             for el in path:
@@ -55,22 +105,26 @@ def sanitize(path):
 
 def plainmessage(metrics):
     """
-    Return message conforming to the graphite line protocol
+    Return message conforming to the graphite line protocol. Every line is
+    terminated with a newline, so messages can follow each other on one
+    connection.
+    Metrics are Metric tuples or plain (path, value, timestamp) tuples.
     """
-    def processtuple(m):
-        return '{m.path} {m.value:g} {m.timestamp:.3f}'.format(**locals())
+    def processtuple(path, value, timestamp):
+        return '{} {:g} {:.3f}\n'.format(path, value, timestamp)
 
-    return '\n'.join(processtuple(metric) for metric in metrics)
+    return ''.join(processtuple(*metric) for metric in metrics)
 
 
 def picklemessage(metrics):
     """
-    Return message conforming to the graphite pickle protocol
+    Return message conforming to the graphite pickle protocol.
+    Metrics are Metric tuples or plain (path, value, timestamp) tuples.
     """
-    def processtuple(m):
-        return m.path.encode('utf-8'), (float(m.timestamp), float(m.value))
+    def processtuple(path, value, timestamp):
+        return path.encode('utf-8'), (float(timestamp), float(value))
 
-    lst = [processtuple(metric) for metric in metrics]
+    lst = [processtuple(*metric) for metric in metrics]
 
     # Use pickle protocol 2 as carbon is python2 only (march 2016)
     payload = pickle.dumps(lst, 2)
@@ -78,26 +132,339 @@ def picklemessage(metrics):
     return header + payload
 
 
+# The encoders below write directly into a reusable bytearray per thread and
+# return bytes ready for socket.sendall.
+_local = threading.local()
+
+PLAINLINE = b'%s %g %.3f\n'
+
+# Pickle protocol 2 opcodes for a list of (path, (timestamp, value)) tuples.
+# The length header is filled in when the message is complete.
+PICKLEHEAD = b'\x00\x00\x00\x00\x80\x02]('
+PICKLETAIL = b'e.'
+SHORT_BINSTRING = struct.Struct('<BB')
+BINSTRING = struct.Struct('<BI')
+POINT = struct.Struct('>BdBdBB')
+LENGTH = struct.Struct('!L')
+
+
+def _buffer():
+    """
+    Return the empty reusable buffer of the current thread.
+    """
+    try:
+        buf = _local.buf
+    except AttributeError:
+        buf = _local.buf = bytearray()
+    del buf[:]
+    return buf
+
+
+def encode_plain(metrics):
+    """
+    Return bytes conforming to the graphite line protocol. Same as
+    plainmessage, but written to a reused buffer.
+    """
+    buf = _buffer()
+    last = None
+    for path, value, timestamp in metrics:
+        # Consecutive metrics often share the same path object.
+        if path is not last:
+            last = path
+            encoded = path.encode('utf-8')
+        buf += PLAINLINE % (encoded, value, timestamp)
+    return bytes(buf)
+
+
+def encode_pickle(metrics):
+    """
+    Return bytes conforming to the graphite pickle protocol. Same as
+    picklemessage, but the pickle opcodes are written directly instead of
+    pickling a list of tuples. Paths are written as python 2 strings, which
+    is what carbon expects.
+    """
+    buf = _buffer()
+    buf += PICKLEHEAD
+    last = None
+    for path, value, timestamp in metrics:
+        if path is not last:
+            last = path
+            encoded = path.encode('utf-8')
+            if len(encoded) < 256:
+                opcode = SHORT_BINSTRING.pack(0x55, len(encoded))
+            else:
+                opcode = BINSTRING.pack(0x54, len(encoded))
+            encoded = opcode + encoded
+        buf += encoded
+        # BINFLOAT timestamp, BINFLOAT value, TUPLE2, TUPLE2
+        buf += POINT.pack(0x47, timestamp, 0x47, value, 0x86, 0x86)
+    buf += PICKLETAIL
+    LENGTH.pack_into(buf, 0, len(buf) - LENGTH.size)
+    return bytes(buf)
+
+
+def _column(values):
+    """
+    Return a column of values as a list of python numbers. NumPy arrays are
+    converted in a single call instead of value by value.
+    """
+    tolist = getattr(values, 'tolist', None)
+    if tolist is not None:
+        return tolist()
+    return values
+
+
+class CarbonConnection(object):
+    """
+    TCP connection to a carbon daemon.
+    A persistent connection is kept open between sends. Broken connections
+    are detected before sending and reopened, with an exponential backoff
+    between failed connection attempts.
+    """
+
+    def __init__(self, host, port, persistent=False, timeout=10,
+                 backoff=1, max_backoff=60):
+        self.address = (host, port)
+        self.persistent = persistent
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.connects = 0
+        self.reconnects = 0
+        self._sock = None
+        self._delay = 0
+        self._next_attempt = 0
+        # Senders on different threads share the socket of a persistent
+        # connection.
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        now = time.time()
+        if now < self._next_attempt:
+            raise socket.error('Not reconnecting to %s:%s for %.1f seconds' %
+                               (self.address[0], self.address[1],
+                                self._next_attempt - now))
+        try:
+            sock = socket.create_connection(self.address, self.timeout)
+        except socket.error:
+            self._delay = min(max(self._delay * 2, self.backoff),
+                              self.max_backoff)
+            self._next_attempt = time.time() + self._delay
+            log.error('Connecting to carbon at %s:%s failed. Backing off '
+                      '%s seconds.', self.address[0], self.address[1],
+                      self._delay)
+            raise
+        if self.persistent and self.connects:
+            self.reconnects += 1
+        self.connects += 1
+        self._delay = 0
+        self._next_attempt = 0
+        self._sock = sock
+        log.debug('Connected to carbon at %s:%s', *self.address)
+
+    def _alive(self):
+        """
+        Carbon never sends anything back. A readable socket therefore means
+        the other end closed the connection or the connection is broken.
+        """
+        try:
+            readable, _, _ = select.select([self._sock], [], [], 0)
+            if readable:
+                return self._sock.recv(1, socket.MSG_PEEK) != b''
+        except (socket.error, select.error, ValueError):
+            return False
+        return True
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except socket.error:
+                pass
+            self._sock = None
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager holding the connection for a batch of messages.
+        Yields a function which sends one message and raises socket.error
+        when it fails. A connection that is not persistent is closed at the
+        end of the batch.
+        """
+        with self._lock:
+            try:
+                yield self._sendall
+            finally:
+                if not self.persistent:
+                    self._close()
+
+    def backing_off(self):
+        """
+        Return True while reconnecting is postponed after a failed attempt.
+        """
+        return time.time() < self._next_attempt
+
+    def stats(self):
+        return {'connects': self.connects, 'reconnects': self.reconnects}
+
+    def sendall(self, message):
+        """
+        Send a message to carbon. Raises socket.error when it fails.
+        """
+        with self.batch() as sendall:
+            sendall(message)
+
+    def _sendall(self, message):
+        if self._sock is not None and not self._alive():
+            log.info('Connection to carbon at %s:%s was closed.',
+                     *self.address)
+            self._close()
+        if self._sock is None:
+            self._connect()
+        try:
+            self._sock.sendall(message)
+        except socket.error:
+            # A persistent connection may have been broken since it was
+            # checked. Retry once on a fresh connection.
+            self._close()
+            if not self.persistent:
+                raise
+            log.info('Sending to carbon at %s:%s failed. Reconnecting.',
+                     *self.address)
+            self._connect()
+            try:
+                self._sock.sendall(message)
+            except socket.error:
+                self._close()
+                raise
+
+
+class CarbonDatagrams(object):
+    """
+    Fire-and-forget UDP transport for the graphite line protocol. Lines are
+    packed into datagrams of at most mtu bytes. A line that is longer than
+    mtu is sent in a datagram of its own.
+    """
+
+    def __init__(self, host, port, mtu=1472):
+        family, socktype, proto, _, address = socket.getaddrinfo(
+            host, port, 0, socket.SOCK_DGRAM)[0]
+        self.address = address
+        self.mtu = mtu
+        self.datagrams = 0
+        self.points = 0
+        self._sock = socket.socket(family, socktype, proto)
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._sock.close()
+
+    def stats(self):
+        return {'datagrams': self.datagrams, 'points': self.points}
+
+    @contextmanager
+    def batch(self):
+        """
+        Same interface as CarbonConnection.batch.
+        """
+        with self._lock:
+            yield self.sendall
+
+    def sendall(self, message):
+        """
+        Send a message of newline terminated lines in as few datagrams as
+        possible. Raises socket.error when sending a datagram fails.
+        """
+        view = memoryview(message)
+        size = len(message)
+        start = 0
+        while start < size:
+            end = start + self.mtu
+            if end < size:
+                # Cut after the last complete line that fits.
+                cut = message.rfind(b'\n', start, end)
+                if cut < 0:
+                    cut = message.find(b'\n', end)
+                    if cut < 0:
+                        cut = size - 1
+                end = cut + 1
+            self._sock.sendto(view[start:end], self.address)
+            self.datagrams += 1
+            start = end
+        self.points += message.count(b'\n')
+
+
 class CarbonSink(object):
     """
     Submit data to carbon.
     """
 
-    def __init__(self, host=None, port=None, protocol='plain', max_buffer=500):
+    def __init__(self, host=None, port=None, protocol='plain', max_buffer=500,
+                 persistent=False, timeout=10, backoff=1, max_backoff=60,
+                 asynchronous=False, queue_size=10000, linger=0.1,
+                 when_full='block', spool=False, spool_dir=None,
+                 spool_name='carbon', spool_max_bytes=64 * 1024 * 1024,
+                 spool_max_age=86400, max_held=10000, mtu=1472,
+                 destinations=None):
         """
         Initialize graphite object with empty buffer. Needs the following
         keyword arguments:
         host: Hostname of the graphite server
         port: Port of the carbon daemon supporting the protocol selected
-        protocol: plain, pickle or dummy
+        protocol: plain, pickle, udp or dummy
         max_buffer: max size of the buffer (number of items in the list)
+        Optional keyword arguments:
+        persistent: keep the connection open between flushes
+        timeout: socket timeout in seconds
+        backoff, max_backoff: first and maximum number of seconds to wait
+        before reconnecting after a failed connection attempt
+        asynchronous: submit to a bounded queue which is drained by a writer
+        thread, instead of flushing on the thread calling submit
+        queue_size: max number of metrics in the queue of an asynchronous sink
+        linger: max number of seconds the writer thread waits for a batch to
+        reach max_buffer metrics before sending it
+        when_full: block, drop-oldest or drop-newest when the queue is full
+        spool: write messages that could not be sent to segment files named
+        spool_name in spool_dir and replay them once carbon is reachable
+        spool_max_bytes: max size of the spool. When the spool is full, metrics
+        are held back in memory
+        spool_max_age: max age in seconds of spooled messages
+        max_held: max number of metrics held back in memory while the spool is
+        full. The oldest are dropped and counted in lost
+        mtu: max payload in bytes of a datagram of the udp protocol. As many
+        lines as fit are packed in each datagram.
+        destinations: list of carbon daemons in the form host:port:instance
+        (instance is optional) to use instead of host and port. Metrics are
+        distributed over them by consistent hashing like carbon-relay does.
+        Each destination has its own buffer and connection.
         """
+        if destinations:
+            options = dict(
+                protocol=protocol, max_buffer=max_buffer,
+                persistent=persistent, timeout=timeout, backoff=backoff,
+                max_backoff=max_backoff, asynchronous=asynchronous,
+                queue_size=queue_size, linger=linger, when_full=when_full,
+                spool=spool, spool_dir=spool_dir,
+                spool_max_bytes=spool_max_bytes, spool_max_age=spool_max_age,
+                max_held=max_held, mtu=mtu)
+            self._shard(destinations, spool_name, options)
+            return
+
         def connection():
             if host and port:
                 log.info('Graphite connection created.\n Connection: %s:%s\n'
-                         'Protocol: %s\nMax buffer: %s', host, port, protocol,
-                         max_buffer)
-                self.connection = (host, port)
+                         'Protocol: %s\nMax buffer: %s\nPersistent: %s',
+                         host, port, protocol, max_buffer, persistent)
+                if protocol == 'udp':
+                    self.connection = CarbonDatagrams(host, port, mtu=mtu)
+                else:
+                    self.connection = CarbonConnection(
+                        host, port, persistent=persistent, timeout=timeout,
+                        backoff=backoff, max_backoff=max_backoff)
             else:
                 raise RuntimeError("Missing host and  port arguments.Example:"
                                    "Graphite(host=localhost, port=2004,"
@@ -105,17 +472,19 @@ class CarbonSink(object):
 
         if protocol == 'pickle':
             connection()
-            self._message = picklemessage
-        elif protocol == 'plain':
+            self._message = encode_pickle
+        elif protocol in ('plain', 'udp'):
             connection()
-            self._message = plainmessage
+            self._message = encode_plain
         elif protocol == 'dummy':
-            self.send = self._dummysend
+            self.connection = None
+            self.sendmany = self._dummysendmany
             self._message = plainmessage
         else:
             raise ValueError('Unknown protocol: %s', protocol)
 
         self.max_buffer = max_buffer
+        self.max_held = max_held
         if max_buffer > 500:
             log.critical('max_buffer higher than 500 could hurt performance')
 
@@ -123,6 +492,119 @@ class CarbonSink(object):
         # supports fast pops and appends on both sides.
         self._buff = deque()
 
+        self.chunks_sent = 0
+        self.bytes_sent = 0
+        self.lost = 0
+
+        self.spool = None
+        if spool and isinstance(self.connection, CarbonConnection):
+            if not spool_dir:
+                raise RuntimeError('Missing spool_dir argument.')
+            self.spool = Spool(spool_dir, spool_name,
+                               max_bytes=spool_max_bytes,
+                               max_age=spool_max_age)
+
+        self.asynchronous = asynchronous
+        self.dropped = 0
+        if asynchronous:
+            if when_full not in WHEN_FULL:
+                raise ValueError('Unknown when_full policy: %s', when_full)
+            self.when_full = when_full
+            self.linger = linger
+            self._queue = Queue(maxsize=queue_size)
+            self._writer = threading.Thread(target=self._drain,
+                                            name='CarbonSinkWriter')
+            self._writer.daemon = True
+            self._writer.start()
+            self.submit = self._enqueue
+            self.flush = self._queue.join
+
+    def _shard(self, destinations, spool_name, options):
+        """
+        Create a CarbonSink for every destination and route all metrics to
+        them.
+        """
+        self._shards = dict()
+        self._destinations = dict()
+        self._routes = PathCache()
+        nodes = list()
+        for destination in destinations:
+            parts = destination.split(':')
+            host, port = parts[0], int(parts[1])
+            instance = parts[2] if len(parts) > 2 else None
+            node = (host, instance)
+            nodes.append(node)
+            self._destinations[node] = destination
+            name = '{}-{}-{}'.format(spool_name, host, port)
+            self._shards[node] = CarbonSink(host=host, port=port,
+                                            spool_name=name, **options)
+        self._ring = ConsistentHashRing(nodes)
+
+        self.submit = self._shardsubmit
+        self.submit_many = self._shardsubmit_many
+        self.submit_columns = self._shardsubmit_columns
+        self.flush = self._shardflush
+        self.close = self._shardclose
+        self.stats = self._shardstats
+
+    def _route(self, path):
+        """
+        Return the CarbonSink of the destination of a sanitized path.
+        """
+        node = self._routes.get(path)
+        if node is None:
+            node = self._ring.get_node(path)
+            self._routes.put(path, node)
+        return self._shards[node]
+
+    def _shardsubmit(self, path, value, timestamp):
+        path = sanitize(path)
+        self._route(path).submit(path, value, timestamp)
+
+    def _shardsubmit_many(self, path, values, timestamps):
+        path = sanitize(path)
+        self._route(path).submit_many(path, values, timestamps)
+
+    def _shardsubmit_columns(self, paths, values, timestamps):
+        values = _column(values)
+        if isinstance(timestamps, numbers.Number):
+            timestamps = repeat(timestamps)
+        else:
+            timestamps = _column(timestamps)
+
+        columns = dict()
+        for path, value, timestamp in zip(paths, values, timestamps):
+            shard = self._route(path)
+            if shard not in columns:
+                columns[shard] = (list(), list(), list())
+            column = columns[shard]
+            column[0].append(path)
+            column[1].append(value)
+            column[2].append(timestamp)
+
+        for shard, column in columns.items():
+            shard.submit_columns(*column)
+
+    def _shardflush(self):
+        chunks = 0
+        nbytes = 0
+        for shard in self._shards.values():
+            written = shard.flush()
+            if written:
+                chunks += written[0]
+                nbytes += written[1]
+        return chunks, nbytes
+
+    def _shardclose(self):
+        for shard in self._shards.values():
+            shard.close()
+
+    def _shardstats(self):
+        stats = dict()
+        for node, shard in self._shards.items():
+            stats[self._destinations[node]] = shard.stats()
+        return {'destinations': stats, 'pathcache': pathcache.stats()}
+
     def submit(self, path, value, timestamp):
         """
         Add a tuple in the form (metric, (timestamp, value)) to the deque
@@ -137,16 +619,164 @@ class CarbonSink(object):
         metric = Metric(path, value, timestamp)
 
         self._buff.append(metric)
-        if len(self._buff) >= self.max_buffer:
+        if self._flushdue(len(self._buff) - 1):
             self.flush()
 
-    def _buffgen(self):
+    def submit_many(self, path, values, timestamps):
+        """
+        Add a series of values for a single metric path to the buffer.
+        Arguments:
+        - path is either a dotted string or a list representing the metric path
+        - values is a sequence of numbers, like a list or a NumPy array
+        - timestamps is a sequence of unix timestamps of the same length as
+          values, or a single timestamp for all values
+        """
+        self.submit_columns(repeat(sanitize(path)), values, timestamps)
+
+    def submit_columns(self, paths, values, timestamps):
+        """
+        Add columns of metric paths, values and timestamps to the buffer.
+        Paths must already be sanitized, see sanitize_many. Values and
+        timestamps are sequences like lists or NumPy arrays. A single
+        timestamp may be given for all values.
+        The metrics are added to the buffer without creating Metric tuples.
+        """
+        values = _column(values)
+        if isinstance(timestamps, numbers.Number):
+            timestamps = repeat(timestamps)
+        else:
+            timestamps = _column(timestamps)
+
+        metrics = zip(paths, values, timestamps)
+        if self.asynchronous:
+            for metric in metrics:
+                self._put(metric)
+            return
+
+        before = len(self._buff)
+        self._buff.extend(metrics)
+        if self._flushdue(before):
+            self.flush()
+
+    def _flushdue(self, before):
+        """
+        Return True if the buffer, which held before metrics, is to be flushed.
+        It is flushed each time it crosses a multiple of max_buffer, so
+        metrics held back after a failed flush do not trigger a flush on every
+        submit. No flush is attempted while the spool is full and the
+        connection is backing off, the buffer is trimmed to max_held instead.
+        """
+        size = len(self._buff)
+        if size // self.max_buffer <= before // self.max_buffer:
+            return False
+        if (self.spool is not None and self.spool.full() and
+                self.connection.backing_off()):
+            self._trim()
+            return False
+        return True
+
+    def _trim(self):
+        """
+        Drop the oldest metrics held back in the buffer beyond max_held.
+        """
+        dropped = 0
+        while len(self._buff) > self.max_held:
+            try:
+                self._buff.popleft()
+            except IndexError:
+                break
+            dropped += 1
+        if dropped:
+            self.lost += dropped
+            log.error('Dropped the %s oldest metrics held back in memory.',
+                      dropped)
+
+    def _enqueue(self, path, value, timestamp):
+        """
+        Add a Metric to the queue of an asynchronous sink. Arguments are the
+        same as for submit.
+        """
+        self._put(Metric(sanitize(path), value, timestamp))
+
+    def _put(self, metric):
+        if self.when_full == 'block':
+            self._queue.put(metric)
+            return
+
+        while True:
+            try:
+                self._queue.put_nowait(metric)
+                return
+            except Full:
+                self.dropped += 1
+                if self.when_full == 'drop-newest':
+                    log.debug('Queue full. Dropped %s', metric[0])
+                    return
+            try:
+                oldest = self._queue.get_nowait()
+            except Empty:
+                continue
+            self._queue.task_done()
+            log.debug('Queue full. Dropped %s', oldest[0])
+
+    def _drain(self):
+        """
+        Writer thread of an asynchronous sink. Sends a batch as soon as it
+        holds max_buffer metrics or linger seconds passed since its first
+        metric was taken from the queue.
+        """
+        stopping = False
+        # Metrics that could neither be sent nor spooled.
+        held = list()
+        while not stopping:
+            batch = held
+            held = list()
+            taken = 0
+            deadline = time.time() + self.linger if batch else None
+            while len(batch) < self.max_buffer:
+                if deadline is None:
+                    metric = self._queue.get()
+                    deadline = time.time() + self.linger
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        metric = self._queue.get(timeout=remaining)
+                    except Empty:
+                        break
+                if metric is _STOP:
+                    # Send what is left, then stop.
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                batch.append(metric)
+                taken += 1
+
+            if not batch:
+                continue
+            try:
+                self.sendmany([self._message(batch)],
+                              restore=lambda: held.extend(batch))
+            except Exception:
+                log.exception('Writer thread failed to send %s metrics.',
+                              len(batch))
+            finally:
+                for _ in range(taken):
+                    self._queue.task_done()
+
+            if held and not stopping:
+                # Carbon is down and the spool is full. Slow down, so the
+                # queue fills up and the when_full policy kicks in.
+                time.sleep(self.connection.max_backoff)
+
+    def _buffgen(self, limit):
         """
         Return a generator which returns Metric tuples from the buffer
-        until empty or max_buffer is reached. FIFO
+        until empty or limit is reached. FIFO
         """
         i = 0
-        while i < self.max_buffer:
+        while i < limit:
             try:
                 yield self._buff.popleft()
                 i += 1
@@ -154,35 +784,146 @@ class CarbonSink(object):
                 log.info('Removed %s metrics from queue', i)
                 break
 
-    def flush(self):
+    def _chunks(self, taken):
         """
-        Flush all metrics found in the buffer to graphite until max_buffer is
-        reached.
+        Return a generator which drains the metrics in the buffer at the time
+        of the call and returns messages of at most max_buffer metrics each.
+        Metrics submitted while draining are left for the next flush.
+        The list taken holds the metrics of the last message returned.
         """
+        remaining = len(self._buff)
+        while remaining > 0:
+            size = min(remaining, self.max_buffer)
+            remaining -= size
+            taken[:] = self._buffgen(size)
+            yield self._message(taken)
 
-        buff = self._buffgen()
+    def flush(self):
+        """
+        Flush all metrics found in the buffer to graphite, in chunks of at
+        most max_buffer metrics over a single connection.
+        Returns the number of chunks and bytes written.
+        """
+        taken = list()
 
-        message = self._message(buff)
+        def restore():
+            self._buff.extendleft(reversed(taken))
+            self._trim()
 
-        self.send(message)
+        chunks, nbytes = self.sendmany(self._chunks(taken), restore=restore)
+        log.info('Flushed %s chunks, %s bytes to graphite.', chunks, nbytes)
+        return chunks, nbytes
 
-    def _dummysend(self, message):
+    def _dummysendmany(self, messages, restore=None):
         """
-        Record the message in the logs and discard it.
+        Record the messages in the logs and discard them.
         """
-        log.info('Dummy protocol:\nSTARTDATA\n%s\nENDDATA', message)
+        chunks = 0
+        nbytes = 0
+        for message in messages:
+            log.info('Dummy protocol:\nSTARTDATA\n%s\nENDDATA', message)
+            chunks += 1
+            nbytes += len(message)
+        self.chunks_sent += chunks
+        self.bytes_sent += nbytes
+        return chunks, nbytes
 
     def send(self, message):
         """
-        Open a socket and send a message to graphite.
+        Send a message to graphite over the carbon connection.
         """
+        self.sendmany([message])
+
+    def sendmany(self, messages, restore=None):
+        """
+        Send messages to graphite over a single carbon connection. Messages
+        are only taken from the iterable as they are sent, so anything after a
+        failure is left alone. With a spool, spooled messages are replayed
+        first and messages that could not be sent are spooled. When the spool
+        is full, restore is called to hand back the metrics of the last
+        message taken from the iterable.
+        Returns the number of messages and bytes sent.
+        """
+        chunks = 0
+        nbytes = 0
+        messages = iter(messages)
+        message = None
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(self.connection)
-            s.sendall(message)
+            with self.connection.batch() as sendall:
+                if self.spool is not None:
+                    self.spool.replay(sendall)
+                for message in messages:
+                    sendall(message)
+                    chunks += 1
+                    nbytes += len(message)
+                    message = None
         except socket.error:
             log.exception('Failed to send data to graphite.')
+            self._spoolmessages(message, messages, restore)
         else:
             log.info('Metrics succesfully sent to graphite.')
-        finally:
-            s.close()
+        self.chunks_sent += chunks
+        self.bytes_sent += nbytes
+        return chunks, nbytes
+
+    def _spoolmessages(self, message, messages, restore):
+        """
+        Spool the message that failed, if any, and the messages after it
+        until the spool is full. Messages are only taken from the iterable
+        while the spool has room, the others stay in the buffer. A message
+        that was taken but could not be spooled is handed back with restore.
+        Without a spool or restore, that message is lost.
+        """
+        if self.spool is None:
+            if message is not None:
+                self.lost += 1
+            return
+        if message is None and not self.spool.full():
+            message = next(messages, None)
+        while message is not None:
+            if not self.spool.append(message):
+                break
+            message = None
+            if not self.spool.full():
+                message = next(messages, None)
+        if message is None:
+            if self.spool.full():
+                log.critical('Spool is full. Holding back metrics in memory.')
+            return
+        log.critical('Spool is full. Holding back metrics in memory.')
+        if restore is not None:
+            restore()
+        else:
+            self.lost += 1
+
+    def close(self):
+        """
+        Close the connection to graphite. An asynchronous sink first sends
+        what is left in its queue and stops its writer thread.
+        """
+        if self.asynchronous and self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join()
+        if self.connection is not None:
+            self.connection.close()
+
+    def stats(self):
+        """
+        Return counters about the connection to graphite.
+        """
+        stats = dict()
+        stats['chunks_sent'] = self.chunks_sent
+        stats['bytes_sent'] = self.bytes_sent
+        stats['lost'] = self.lost
+        if self.connection is not None:
+            stats.update(self.connection.stats())
+        if self.asynchronous:
+            stats['queue_depth'] = self._queue.qsize()
+            stats['dropped'] = self.dropped
+        stats['pathcache'] = pathcache.stats()
+        if self.spool is not None:
+            stats['spool_bytes'] = len(self.spool)
+            stats['spooled'] = self.spool.spooled
+            stats['replayed'] = self.spool.replayed
+            stats['spool_expired'] = self.spool.expired
+        return stats
@@ -0,0 +1,145 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from builtins import object
+import logging
+import os
+import struct
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Every record in a segment file is prefixed with its length.
+HEADER = struct.Struct('!L')
+
+
+class Spool(object):
+    """
+    Write-ahead spool of messages that could not be sent to carbon.
+    Messages are appended to segment files and replayed in order. A segment
+    is removed once all of its messages have been replayed. Segments older
+    than max_age seconds are discarded. When the spool holds max_bytes,
+    append refuses new messages so the caller can hold on to them.
+    """
+
+    Extension = '.spool'
+
+    def __init__(self, storagedir, name, max_bytes=64 * 1024 * 1024,
+                 max_age=86400, segment_bytes=1024 * 1024):
+        self.storagedir = storagedir
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_bytes = segment_bytes
+        self.spooled = 0
+        self.replayed = 0
+        self.expired = 0
+        # Bytes of the oldest segment that are already replayed.
+        self._offset = 0
+        self._lock = threading.Lock()
+
+        segments = self._segments()
+        self._bytes = sum(os.path.getsize(s) for s in segments)
+        if segments:
+            log.warning('Spool %s holds %s bytes in %s segments to replay.',
+                        self.name, self._bytes, len(segments))
+
+    def __len__(self):
+        return self._bytes
+
+    def _segments(self):
+        prefix = self.name + '-'
+        length = len(prefix) + 10 + len(self.Extension)
+        names = [n for n in os.listdir(self.storagedir)
+                 if n.startswith(prefix) and n.endswith(self.Extension) and
+                 len(n) == length]
+        return [os.path.join(self.storagedir, n) for n in sorted(names)]
+
+    def _segment(self, seq):
+        return os.path.join(self.storagedir, '{}-{:010d}{}'.format(
+            self.name, seq, self.Extension))
+
+    def _remove(self, segment):
+        self._bytes -= os.path.getsize(segment)
+        os.remove(segment)
+
+    def _expire(self):
+        """
+        Remove segments that were last written more than max_age seconds ago.
+        """
+        oldest = time.time() - self.max_age
+        for segment in self._segments():
+            if os.path.getmtime(segment) >= oldest:
+                break
+            log.warning('Discarding spool segment older than %s seconds: %s',
+                        self.max_age, segment)
+            self._remove(segment)
+            self._offset = 0
+            self.expired += 1
+
+    def full(self):
+        return self._bytes >= self.max_bytes
+
+    def append(self, message):
+        """
+        Append a message to the spool. Returns False if the spool is full.
+        """
+        with self._lock:
+            if self._bytes:
+                self._expire()
+            size = HEADER.size + len(message)
+            if self._bytes + size > self.max_bytes:
+                return False
+
+            segments = self._segments()
+            if not segments:
+                segment = self._segment(0)
+            elif os.path.getsize(segments[-1]) >= self.segment_bytes:
+                seq = int(segments[-1][-len(self.Extension) - 10:
+                                       -len(self.Extension)])
+                segment = self._segment(seq + 1)
+            else:
+                segment = segments[-1]
+
+            try:
+                with open(segment, 'ab') as f:
+                    f.write(HEADER.pack(len(message)) + message)
+            except (IOError, OSError):
+                log.exception('Failed to write to spool segment %s', segment)
+                return False
+            self._bytes += size
+            self.spooled += 1
+            return True
+
+    def replay(self, send):
+        """
+        Replay all messages in the spool in order using the send function.
+        Any exception raised by send stops the replay. The message that
+        failed is replayed again the next time.
+        """
+        with self._lock:
+            if not self._bytes:
+                return
+            self._expire()
+            for segment in self._segments():
+                with open(segment, 'rb') as f:
+                    f.seek(self._offset)
+                    while True:
+                        header = f.read(HEADER.size)
+                        if not header:
+                            break
+                        message = None
+                        if len(header) == HEADER.size:
+                            length, = HEADER.unpack(header)
+                            message = f.read(length)
+                        if message is None or len(message) < length:
+                            # Left behind by a crash while appending.
+                            log.error('Discarding truncated record in spool '
+                                      'segment %s', segment)
+                            break
+                        send(message)
+                        self._offset = f.tell()
+                        self.replayed += 1
+                self._remove(segment)
+                self._offset = 0
+                log.info('Replayed spool segment %s', segment)